@@ -8,29 +8,48 @@ vt_server
 This is a Voice Transformation server. It receives command stacks as JSON arrays
 to process sound files that are local on the server, and returns a pointer to the processed file.
 
+The server runs on :py:mod:`asyncio`: connections do not hold a thread while the jobs are
+being processed, they simply await the completion of the job.
+
 .. Created on 2020-03-20.
 """
 
-import socketserver
+import asyncio
 import json
 import os, traceback
 import vt_server_logging as vsl
+import vt_server_config as vsc
+import vt_server_common_tools as vsct
 from vt_server_modules import discover_modules
 import vt_server_brain
-# optional
-import threading
+import vt_server_cache
 
 
 __version__ = "2.3"
 __author__  = "Etienne Gaudrain"
 
 
-class VTHandler(socketserver.StreamRequestHandler):
+class VTHandler():
     """
     The handler for the server requests.
 
-    Requests are JSON encoded. It is required that they contain the following field
-    `action` which can receive one of two values: `"status"` or `"process"`.
+    Requests are JSON encoded, one request per line. It is required that they contain the following field
+    `action` which can receive one of three values: `"status"`, `"process"` or `"process_many"`.
+
+    Whatever the action, the following fields are optional:
+
+        id
+          An identifier (any JSON value) that is echoed back in the response. This is useful
+          to match the responses with the requests when several requests are sent on the same
+          connection, as responses are sent as soon as they are ready, not necessarily in the order
+          the requests were received.
+
+        keep_alive
+          If `true`, the connection is kept open after the request so that other requests can be
+          sent on the same connection. Requests can also be pipelined (sent without waiting for the
+          previous responses). The connection is closed once a request without `keep_alive` has been
+          answered (together with all the previous ones), when the client closes its side of the
+          connection, or after :py:attr:`keep_alive_timeout` seconds without a new request.
 
     If **action** is  `"status"`, then no other field is required.
 
@@ -55,7 +74,12 @@ class VTHandler(socketserver.StreamRequestHandler):
           the files if **file** is an array (otherwise, the same stack is applied
           to all files before concatenation).
 
-    The following fields are optional:
+    If **action** is `"process_many"`, the request must contain a **queries** field that is a list
+    of `"process"` queries (the `action` field of the queries can be omitted). The
+    **mode** of the request applies to all the queries. The `details` of the response is the list
+    of the responses to the individual queries (see :py:func:`vt_server_brain.submit_many`).
+
+    For `"process"`, the following fields are optional:
 
         mode
           `"sync"` [default], `"async"` or `"hash"`. In `sync` mode, the server will only
@@ -64,6 +88,12 @@ class VTHandler(socketserver.StreamRequestHandler):
           periodically with the same request until the file is returned. `hash` only
           returns the hash of the request that is used as identifier.
 
+        timeout
+          In `async` mode, the number of seconds the server may hold the request while the file
+          is being processed. The response is sent as soon as the job is done, or when the timeout
+          expires (with `"wait"`), whichever comes first. This is a more efficient way of probing the server
+          than resending the same request at short intervals.
+
         format
           Specifies the output format of the sound files. Can be `"flac"`, `"wav"`
           (or anything else supported by `libsndfile <http://www.mega-nerd.com/libsndfile/>`_, or `"mp3"`
@@ -85,32 +115,168 @@ class VTHandler(socketserver.StreamRequestHandler):
           cache status from their parents. If not provided, the cache value is 730, which
           corresponds roughly to 1 month.
 
+        return
+          `"path"` [default] or `"bytes"`. With `"bytes"`, when the response is `"ok"`, the
+          content of the output file is sent right after the JSON response line, so that the client does not
+          need to access the file system of the server. The response then has a **size** field that gives the
+          number of bytes that follow.
+
     The response is also JSON and has the following form:
 
         out
-          `"ok"`, `"error"`, or `"wait"`
+          `"ok"`, `"error"`, `"wait"` or `"busy"`. `"busy"` means that the job queue of the
+          server is full and that the request should be sent again later.
 
         details
           In case of success, this contains the outcome of the processing. In case of error,
           this has some details about the error.
+
+        id
+          The **id** of the request, if one was provided.
+
+        size
+          The size (in bytes) of the file sent after the response, if `"return": "bytes"` was requested.
     """
-    def handle(self):
+
+    #: How long (in seconds) a `keep_alive` connection is kept open without receiving requests.
+    keep_alive_timeout = 300
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.client_address = writer.get_extra_info('peername')
+        self.write_lock = asyncio.Lock()
+
+    async def handle(self):
+        """
+        The handler coroutine. It reads the requests line by line and dispatches each of
+        them to :py:meth:`respond` as a separate task, until a request does not ask to
+        keep the connection alive. Once all the requests have been answered, the connection is closed.
+        """
+        tasks = list()
+        keep_alive = True
+        while keep_alive:
+            try:
+                data = await asyncio.wait_for(self.reader.readline(), self.keep_alive_timeout)
+            except asyncio.TimeoutError:
+                vsl.LOG.debug("Closing idle connection from {}.".format(self.client_address[0]))
+                break
+            except (ValueError, ConnectionError) as err:
+                # The line is too long or the connection was reset
+                vsl.LOG.debug("Could not read from {}: {}".format(self.client_address[0], repr(err)))
+                break
+
+            if not data:
+                # The client closed the connection
+                break
+
+            self.data = data.strip()
+            vsl.LOG.debug("Received from {}: {}.".format(self.client_address[0], self.data))
+            try:
+                req = json.loads(self.data.decode('utf-8'))
+                keep_alive = isinstance(req, dict) and req.get('keep_alive', False) is True
+            except Exception:
+                req = self.data
+                keep_alive = False
+
+            tasks.append(asyncio.create_task(self.respond(req)))
+
+        if len(tasks)>0:
+            await asyncio.gather(*tasks)
+
+        try:
+            self.writer.close()
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def respond(self, req):
+        """
+        Handles a single request and sends the response back to the client.
+        """
+        msg = await self.handle_request(req)
+
+        payload = None
+        if isinstance(req, dict) and req.get('action')=='process' and req.get('return')=='bytes' and msg['out']=='ok':
+            if not isinstance(msg['details'], str):
+                # A sweep makes several files
+                msg = {'out': 'error', 'details': "'return': 'bytes' cannot be used for a query that makes several files (a sweep)."}
+            else:
+                try:
+                    # Reading the file into the hot cache must not block the event loop
+                    payload = await asyncio.get_running_loop().run_in_executor(None, self.open_payload, msg['details'])
+                    msg['size'] = payload[1]
+                except Exception as err:
+                    vsl.LOG.debug("Could not open {} to send it: {}".format(msg['details'], repr(err)))
+                    msg = {'out': 'error', 'details': "The file '%s' could not be read: %s" % (msg['details'], str(err))}
+
+        if isinstance(req, dict) and 'id' in req:
+            msg['id'] = req['id']
+
+        msg_b = json.dumps(msg).encode('utf-8')+b"\n"
+        #vsl.LOG.debug("Sending: {}".format(repr(msg_b)))
+        try:
+            async with self.write_lock:
+                self.writer.write(msg_b)
+                if payload is not None:
+                    await self.send_payload(payload[0])
+                await self.writer.drain()
+        except ConnectionError as err:
+            vsl.LOG.debug("Could not send the response to {}: {}".format(self.client_address[0], repr(err)))
+        except Exception as err:
+            vsl.LOG.error("Something went wrong while sending the response to {}: {}".format(self.client_address[0], traceback.format_exc()))
+        finally:
+            if payload is not None and not isinstance(payload[0], bytes):
+                payload[0].close()
+
+    @staticmethod
+    def open_payload(filename):
+        """
+        Gets the content of **filename** ready to be sent: from the :py:class:`vt_server_brain.HotCache` if
+        it is kept in memory there, otherwise as an open file.
+
+        :return: A tuple ``(content, size)`` where **content** is either `bytes` or a file object.
         """
-        The handler function. It basically receives the query in JSON, tries to parse it and then
-        dispatch to :py:func:`vt_server_brain.process` if it worked. Then sends the response back
-        to the client.
+        if vt_server_brain.HOT_CACHE is not None and vt_server_brain.HOT_CACHE.max_bytes > 0:
+            content = vt_server_brain.HOT_CACHE.read(filename)
+            if content is not None:
+                return content, len(content)
+        f = open(filename, 'rb')
+        return f, os.fstat(f.fileno()).st_size
+
+    async def send_payload(self, content):
+        """
+        Writes **content** (`bytes` or a file object) to the client. Files are sent with
+        :py:meth:`asyncio.loop.sendfile`, which uses :py:func:`os.sendfile` where available.
+        """
+        if isinstance(content, bytes):
+            self.writer.write(content)
+        else:
+            await self.writer.drain()
+            await asyncio.get_running_loop().sendfile(self.writer.transport, content)
+
+    async def handle_request(self, req):
+        """
+        This is where the request is processed. If the request is still in its raw form, it
+        is parsed from JSON. It is then dispatched to :py:func:`vt_server_brain.submit`. If the
+        job needs to be waited for, its future is awaited.
+
+        :return: The response as a `dict`.
         """
-        self.data = self.rfile.readline().strip()
-        vsl.LOG.debug("Received from {}: {}.".format(self.client_address[0], self.data))
         msg = dict()
         try:
-            req = json.loads(self.data.decode('utf-8'))
+            if not isinstance(req, dict):
+                req = json.loads(req.decode('utf-8'))
             if req['action']=='status':
                 msg['out'] = 'ok'
                 msg['details'] = 'We have processed %d requests since startup and there are now %d jobs in the JOBS list.' % (vt_server_brain.N_REQUESTS, len(vt_server_brain.JOBS))
+                if vt_server_brain.WORKER_POOL is not None:
+                    msg['details'] += ' %d jobs are pending in the worker pool.' % vt_server_brain.WORKER_POOL.n_pending
                 vsl.LOG.debug("This is the status: {}.".format(msg['details']))
             elif req['action']=='process':
-                msg = vt_server_brain.process(req)
+                msg = await self.wait_for_response(await self.submit(vt_server_brain.submit, req))
+            elif req['action']=='process_many':
+                msg = await self.wait_for_response(await self.submit(vt_server_brain.submit_many, req))
             else:
                 vsl.LOG.debug("Got a request with wrong 'action' field.")
                 msg['out'] = 'error'
@@ -120,38 +286,112 @@ class VTHandler(socketserver.StreamRequestHandler):
             msg['out'] = 'error'
             msg['details'] = traceback.format_exc()
 
-        msg_b = json.dumps(msg).encode('utf-8')+b"\n"
-        #vsl.LOG.debug("Sending: {}".format(repr(msg_b)))
-        self.wfile.write(msg_b)
-        #self.wfile.close()
-        #vsl.LOG.debug("Sent.")
+        return msg
+
+    @staticmethod
+    async def submit(fn, req):
+        """
+        Calls ``fn(req)``, where **fn** is :py:func:`vt_server_brain.submit` or :py:func:`vt_server_brain.submit_many`,
+        in a thread not to block the event loop: submitting a query accesses the file system (source fingerprints, see
+        :py:func:`vt_server_common_tools.source_fingerprint`, cache files, claims, cache index), and may have to restart
+        the :py:class:`vt_server_brain.WorkerPool`.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, fn, req)
+
+    @staticmethod
+    async def wait_for_response(msg):
+        """
+        If **msg** is a :py:class:`vt_server_brain.ResponseFuture`, awaits its result, or its timeout.
+        """
+        if not isinstance(msg, vt_server_brain.ResponseFuture):
+            return msg
+        try:
+            # The future is shielded so that a timeout does not cancel the job
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(msg)), msg.timeout)
+        except asyncio.TimeoutError:
+            return msg.timeout_response
+
+class VTServer():
+    """
+    The server. Each connection is handled by a **handler_class** instance (:py:class:`VTHandler`),
+    in the :py:mod:`asyncio` event loop.
+
+    :param server_address: A ``(host, port)`` tuple.
+    :param handler_class: The class used to handle the connections.
+    """
+
+    #: The maximum length of a request (in bytes).
+    request_size_limit = 2**24
 
-class VTServer(socketserver.ThreadingTCPServer):
+    def __init__(self, server_address, handler_class):
+        self.server_address = server_address
+        self.handler_class = handler_class
+        self.server = None
+
+    async def handle_connection(self, reader, writer):
+        await self.handler_class(reader, writer).handle()
+
+    async def serve(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.server_address[0], self.server_address[1], limit=self.request_size_limit)
+        self.server_activate()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def serve_forever(self):
+        """
+        Runs the server until it is interrupted.
+        """
+        asyncio.run(self.serve())
 
     def server_activate(self):
-        super().server_activate()
 
-        # Instanciating the janitor for periodic 400s check
-        vt_server_brain.JOB_JANITOR = vt_server_brain.Janitor(400)
+        # Starting the workers first, so that the pool does not fork while other threads are running
+        vt_server_brain.WORKER_POOL = vt_server_brain.WorkerPool(vsc.CONFIG['workers'], vsc.CONFIG['queuesize'])
+
+        # Instanciating the janitor for periodic 60s check
+        vt_server_brain.JOB_JANITOR = vt_server_brain.Janitor(60)
+
+        # Keeping the cache size under control
+        if vsc.CONFIG['maxcachesize'] is not None:
+            vt_server_brain.CACHE_EVICTOR = vt_server_brain.CacheEvictor(60)
+
+        # Cleaning up the cache, little by little
+        if vsc.CONFIG['cleanupinterval'] is not None:
+            vt_server_brain.CACHE_CLEANER = vt_server_brain.CacheCleaner(vsc.CONFIG['cleanupinterval'])
+
+        # Coordinating with the other servers using the same cache
+        if vsc.CONFIG['sharedcache']:
+            vt_server_brain.CLAIM_KEEPER = vt_server_brain.ClaimKeeper(.5)
+
+        # Keeping the most requested files at hand
+        vt_server_brain.HOT_CACHE = vt_server_brain.HotCache(vsc.CONFIG['hotcachesize'], vsc.CONFIG['hotcachebytes']*1024**2)
+        vt_server_cache.ON_DELETE.append(vt_server_brain.HOT_CACHE.invalidate)
 
         vsl.LOG.info("Running VTServer version {} on {}:{}.".format(__version__, self.server_address[0], self.server_address[1]))
 
     def server_close(self):
         print('\nTerminating.')
-        super().server_close()
         if vt_server_brain.JOB_JANITOR is not None:
             vt_server_brain.JOB_JANITOR.kill()
+        if vt_server_brain.CACHE_EVICTOR is not None:
+            vt_server_brain.CACHE_EVICTOR.kill()
+        if vt_server_brain.CACHE_CLEANER is not None:
+            vt_server_brain.CACHE_CLEANER.kill()
+        if vt_server_brain.CLAIM_KEEPER is not None:
+            vt_server_brain.CLAIM_KEEPER.kill()
+        if vt_server_brain.WORKER_POOL is not None:
+            vt_server_brain.WORKER_POOL.kill()
+        vsct.flush_job_files()
 
 def main():
     """
     Imports the configuration, instantiates a :class:`VTServer` and starts
-    the :class:`vt_server_brain.Janitor` before starting the server itself.
+    the :class:`vt_server_brain.Janitor` and the :class:`vt_server_brain.WorkerPool`
+    before starting the server itself.
 
     Runs forever until the server receives SIGINT.
     """
 
-    import vt_server_config as vsc
-
     config = vsc.CONFIG
 
     #if os.access(config['logfile'], os.W_OK):
@@ -175,7 +415,6 @@ def main():
         server.serve_forever()
     except KeyboardInterrupt:
         vsl.LOG.info("Shutting down the server...")
-        server.shutdown()
     finally:
         server.server_close()
         vsl.LOG.info("Bye!")
@@ -6,8 +6,8 @@ vt_server_brain
 ===============
 
 Dispatches the processing to the right underlings. The brain also manages the
-various processes and the main cache. Each request is dispatched to its own
-process as a **job**.
+various processes and the main cache. Each request is dispatched as a **job** to
+the :py:class:`WorkerPool`, a pool of pre-started worker processes.
 
 Jobs have a signature that is based on the task at hand:
 
@@ -20,11 +20,16 @@ signature. The job signature is also used for the name of the cache file.
 
 Everytime a job is submitted, the brain first checks if the file already exists.
 If the file exists, it is returned right away. If the file does not exist, then
-we check if the job is in the :py:data:`JOBS` list (a managed dictionary). If it is in
-the list, then we just reply `'wait'` to the client. If not, then the brain
-creates the job and starts the process.
+we check if the job is being processed. If it is, the query is attached to the
+future of the running job (see :py:data:`JOB_FUTURES`), so identical queries never start the
+same job twice. If not, then the brain
+creates the job and submits it to the :py:data:`WORKER_POOL`. The number of jobs
+that can be queued in the pool is limited (see the `queuesize` option in
+:py:mod:`vt_server_config`). If the queue is full, the request is turned down with
+a `'busy'` response.
 
-In `'sync'` mode, the dispatcher waits for the process to be completed.
+In `'sync'` mode, the dispatcher waits for the process to be completed, whether the query
+started the job or was attached to it.
 
 In `'async'` mode (default) it returns right away and sends a `'wait'` message. The client can
 send the same request a bit later. If the job is still being processed, the server
@@ -37,6 +42,9 @@ they need to manage it themselves.
 A :py:class:`Janitor` is scouring the :py:data:`JOBS` list to check on jobs that may be finished,
 and remove them from the list.
 
+Several servers of the same machine can share the same cache folder (`sharedcache` option). A job is then claimed
+by the server that processes it, and the other servers wait for its output (see :py:class:`ClaimKeeper`).
+
 .. Created on 2020-03-20.
 """
 
@@ -44,19 +52,22 @@ import vt_server_config as vsc
 import vt_server_logging as vsl
 import vt_server_common_tools as vsct
 import vt_server_modules as vsm
+import vt_server_cache as vscache
 
-import os, datetime, pickle, copy, traceback
-from multiprocessing import Process, Manager, active_children
-from threading import Event, Thread
+import os, datetime, pickle, copy, traceback, time, json, socket, itertools
+from concurrent.futures import ProcessPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from threading import Event, Thread, Lock, get_native_id
+from collections import OrderedDict
 import subprocess
 from enum import IntEnum
 
 import soundfile as sf
 import numpy as np
 
-manager = Manager()
-#: This is the list of current jobs (actually a managed dict).
-JOBS = manager.dict()
+#: This is the list of current jobs. It lives in the server process only: the workers
+#: return the response of their job, which is stored here when the job is done.
+JOBS = dict()
 N_REQUESTS = 0 # This is just for information purposes.
 
 SUPPORTED_SOUND_EXTENSIONS = [x.lower() for x in sf.available_formats().keys()]
@@ -76,7 +87,11 @@ class Janitor():
 
         def loop():
             while not stopped.wait(interval): # the first call is in `interval` secs
-                self.janitor_job()
+                try:
+                    self.janitor_job()
+                except Exception as err:
+                    # The janitor has to keep going
+                    vsl.LOG.error("Janitor: Something went wrong during the round of %s: %s" % (type(self).__name__, traceback.format_exc()))
 
         vsl.LOG.debug("Starting a janitor...")
         self.thread = Thread(target=loop).start()
@@ -100,52 +115,455 @@ class Janitor():
     def janitor_job():
         """
         Checks periodically on the :py:data:`JOBS` list to see if there are any
-        process that is finished and needs removing.
+        process that is finished and needs removing. Also writes the accesses to
+        cache files in the cache index (see :py:func:`vt_server_common_tools.flush_job_files`).
         """
 
-        Ps = dict()
-        for p in active_children():
-            Ps[p.pid] = p
-
-        vsl.LOG.debug("Janitor: Hi! this is the janitor, I will inspect %d jobs and %d process(es)." % (len(JOBS), len(Ps)))
+        vsl.LOG.debug("Janitor: Hi! this is the janitor, I will inspect %d jobs." % len(JOBS))
 
         live_processes = 0
         removed_processes = 0
 
-        for k in list(JOBS.keys()):
-            if JOBS[k]['started_at'] + datetime.timedelta(minutes=10) > datetime.datetime.now():
-                # Job is less than 10 min old, we skip
-                live_processes += 1
-                continue
-            elif JOBS[k]['finished']:
-                del JOBS[k]
-                removed_processes += 1
-            elif (JOBS[k]['pid'] is not None) and (JOBS[k]['pid'] not in Ps):
-                # None is for queries with sub-queries before the main stack is processed
-                vsl.LOG.info("Janitor: Job %s terminated without setting its `finished` status to True and is being deleted." % k)
-                del JOBS[k]
-                removed_processes += 1
-            else:
-                live_processes += 1
+        with JOBS_LOCK:
+            # Jobs are added and removed by other threads
+            for k in list(JOBS.keys()):
+                if JOBS[k]['started_at'] + datetime.timedelta(minutes=10) > datetime.datetime.now():
+                    # Job is less than 10 min old, we skip
+                    live_processes += 1
+                    continue
+                elif JOBS[k]['finished']:
+                    del JOBS[k]
+                    removed_processes += 1
+                elif k not in JOB_FUTURES:
+                    # The job is not in the worker pool anymore (e.g. the pool was restarted)
+                    vsl.LOG.info("Janitor: Job %s terminated without setting its `finished` status to True and is being deleted." % k)
+                    del JOBS[k]
+                    removed_processes += 1
+                else:
+                    live_processes += 1
 
         vsl.LOG.debug("Janitor: I found %d live or valid processes and removed %d from the list." % (live_processes, removed_processes))
 
+        try:
+            n = vsct.flush_job_files()
+            vsl.LOG.debug("Janitor: I recorded the accesses to %d cache files." % n)
+        except Exception as err:
+            vsl.LOG.error("Janitor: Something went wrong while recording the accesses to the cache files: %s" % repr(err))
+
+        if HOT_CACHE is not None:
+            HOT_CACHE.validate()
+
 # Instanciating the janitor for periodic 30s check
 #JOB_JANITOR = Janitor(30)
 JOB_JANITOR = None # now instantiated manually
 
+class CacheEvictor(Janitor):
+    """
+    Periodically removes the least used files from the cache when its size approaches the
+    `maxcachesize` of the configuration (see :py:func:`vt_server_cache.evict_cache`).
+    """
+
+    @staticmethod
+    def janitor_job():
+        try:
+            n_files, n_bytes = vscache.evict_cache(verbose=False)
+            if n_files>0:
+                vsl.LOG.info("CacheEvictor: Removed %d files (%.1f MB) from the cache." % (n_files, n_bytes/1024**2))
+        except Exception as err:
+            vsl.LOG.error("CacheEvictor: Something went wrong while evicting files from the cache: %s" % repr(err))
+
+#: The :py:class:`CacheEvictor`, instantiated by the server if a `maxcachesize` is set.
+CACHE_EVICTOR = None
+
+class CacheCleaner(Janitor):
+    """
+    Cleans up the cache from within the server, a little at a time: every `interval` seconds, one batch of
+    the cache index is checked (see :py:func:`vt_server_cache.cleanup_cache_batch`). Once the whole index has
+    been checked, the cleaner starts over. The thread of the cleaner runs at the lowest priority when the system allows it.
+    """
+
+    def __init__(self, interval):
+        self.after = ''
+        self.known = dict()
+        self.niced = False
+        super().__init__(interval)
+
+    def janitor_job(self):
+        if not self.niced:
+            self.niced = True
+            try:
+                # On Linux, threads have their own priority
+                os.setpriority(os.PRIO_PROCESS, get_native_id(), 19)
+            except (AttributeError, OSError):
+                pass
+
+        try:
+            fold = os.path.abspath(vsc.CONFIG['cachefolder'])
+            # The expiration dates of the files accessed lately are not in the index yet
+            vsct.flush_job_files(fold)
+            self.after, n = vscache.cleanup_cache_batch(fold, self.after, False, self.known, verbose=False)
+            if n>0:
+                vsl.LOG.info("CacheCleaner: Removed %d files from the cache." % n)
+            if self.after is None:
+                # We start a new pass, and check all the files again
+                self.after = ''
+                self.known = dict()
+        except Exception as err:
+            vsl.LOG.error("CacheCleaner: Something went wrong while cleaning up the cache: %s" % repr(err))
+
+#: The :py:class:`CacheCleaner`, instantiated by the server if a `cleanupinterval` is set.
+CACHE_CLEANER = None
+
+class HotCache():
+    """
+    An in-memory LRU list of the output files of the last jobs that were requested, so that popular queries
+    are answered without accessing the file system. Optionally, the content of the files is also kept in memory.
+
+    Files are removed from the list when they are deleted by :py:mod:`vt_server_cache` in the server process.
+    Files deleted by other processes are found by :py:meth:`validate`, which is called by the :py:class:`Janitor`:
+    until then, they are still in the list.
+
+    :param size: The maximum number of files in the list.
+    :param max_bytes: The maximum number of bytes of file content kept in memory.
+    """
+
+    def __init__(self, size, max_bytes=0):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.entries = OrderedDict() # filename -> content (or None)
+        self.lock = Lock()
+
+    def __contains__(self, filename):
+        with self.lock:
+            if filename not in self.entries:
+                return False
+            self.entries.move_to_end(filename)
+            return True
+
+    def add(self, filename):
+        with self.lock:
+            if filename in self.entries:
+                self.entries.move_to_end(filename)
+                return
+            self.entries[filename] = None
+            while len(self.entries) > self.size:
+                _, content = self.entries.popitem(last=False)
+                if content is not None:
+                    self.n_bytes -= len(content)
+
+    def read(self, filename):
+        """
+        Returns the content of **filename** if it is kept in memory. If it is not, but the file is in the list
+        and is smaller than `max_bytes`, it is read and kept in memory (dropping the content of the least recently
+        used files if needed). Otherwise, returns ``None``.
+        """
+        with self.lock:
+            if filename not in self.entries:
+                return None
+            content = self.entries[filename]
+        if content is not None or os.path.getsize(filename) > self.max_bytes:
+            return content
+
+        with open(filename, 'rb') as f:
+            content = f.read()
+
+        with self.lock:
+            if filename in self.entries and self.entries[filename] is None and len(content) <= self.max_bytes:
+                while self.n_bytes+len(content) > self.max_bytes:
+                    # Dropping the content of the least recently used files
+                    lru = next(k for k, c in self.entries.items() if c is not None)
+                    self.n_bytes -= len(self.entries[lru])
+                    self.entries[lru] = None
+                self.entries[filename] = content
+                self.n_bytes += len(content)
+        return content
+
+    def invalidate(self, filename):
+        with self.lock:
+            content = self.entries.pop(os.path.abspath(filename), None)
+            if content is not None:
+                self.n_bytes -= len(content)
+
+    def validate(self):
+        """
+        Removes the files that do not exist anymore from the list.
+        """
+        with self.lock:
+            filenames = list(self.entries.keys())
+        for f in filenames:
+            if not os.path.exists(f):
+                self.invalidate(f)
+
+#: How long (in seconds) a claim on a job lasts if it is not renewed by the server that holds it.
+CLAIM_LEASE = 60
+
+class ClaimKeeper(Janitor):
+    """
+    Coordinates the servers that share the same cache folder, so that a job is only processed by one of them.
+
+    Before starting a job, the server claims it by creating a claim file in the :file:`_claims_` folder
+    of the cache (see :py:meth:`claim`). The claims are renewed every :py:data:`CLAIM_LEASE`/3 seconds
+    while the jobs are running, and removed once they are done. If a job is already claimed by another server,
+    the job waits for the output file of the other server (see :py:meth:`wait`). If the claim is released
+    without output, or if it expires because the other server is gone, the job is claimed and processed here.
+
+    Every `interval` seconds, the waiting jobs are checked and the claims are renewed.
+    """
+
+    def __init__(self, interval):
+        self.lock = Lock()
+        self.claims = dict() # Jobs claimed by this server: h -> claim file
+        self.waiting = dict() # Jobs claimed by other servers: h -> (req, out_filename, job)
+        self.last_heartbeat = time.time()
+        self.folder = os.path.join(os.path.abspath(vsc.CONFIG['cachefolder']), '_claims_')
+        os.makedirs(self.folder, exist_ok=True)
+        super().__init__(interval)
+
+    def claim(self, h):
+        """
+        Tries to claim job **h**. An expired claim is broken. Note that if two servers break the same expired claim at
+        the same time, they may both process the job, which is harmless since cache files are written atomically.
+
+        :return: ``True`` if the job is now claimed by this server, ``False`` if it is claimed by another server.
+        """
+        f = os.path.join(self.folder, h+".claim")
+        for attempt in range(2):
+            try:
+                fd = os.open(f, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    if os.stat(f).st_mtime > time.time() - CLAIM_LEASE:
+                        return False
+                    vsl.LOG.info("[%s] Breaking the expired claim on the job." % h)
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, 'w') as fp:
+                json.dump({'host': socket.gethostname(), 'pid': os.getpid()}, fp)
+            with self.lock:
+                self.claims[h] = f
+            return True
+        return False
+
+    def release(self, h):
+        """
+        Releases the claim on job **h**, if this server holds it.
+        """
+        with self.lock:
+            f = self.claims.pop(h, None)
+        if f is not None:
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+
+    def wait(self, req, h, out_filename, job):
+        """
+        Makes job **h**, claimed by another server, wait for **out_filename**. The future **job** is then finished, or
+        the job is started (see :py:func:`start_job`) if the other server gives up on it.
+        """
+        with self.lock:
+            self.waiting[h] = (req, out_filename, job)
+
+    def janitor_job(self):
+        now = time.time()
+        if now - self.last_heartbeat > CLAIM_LEASE/3:
+            self.last_heartbeat = now
+            with self.lock:
+                claims = list(self.claims.values())
+            for f in claims:
+                try:
+                    os.utime(f)
+                except FileNotFoundError:
+                    pass
+
+        with self.lock:
+            waiting = list(self.waiting.items())
+        for h, (req, out_filename, job) in waiting:
+            try:
+                if os.access(out_filename, os.R_OK):
+                    with self.lock:
+                        self.waiting.pop(h)
+                    vsl.LOG.debug("[%s] The job was processed by another server." % h)
+                    finish_job(h, job, {'out': 'ok', 'details': out_filename})
+                elif self.claim(h):
+                    with self.lock:
+                        self.waiting.pop(h)
+                    vsl.LOG.info("[%s] The job was given up by another server, we process it." % h)
+                    start_job(req, h, out_filename, job)
+            except Exception as err:
+                vsl.LOG.error("ClaimKeeper: Something went wrong while checking on job %s: %s" % (h, repr(err)))
+
+#: The :py:class:`ClaimKeeper`, instantiated by the server if `sharedcache` is set. If ``None``, jobs are not claimed.
+CLAIM_KEEPER = None
+
+#: The :py:class:`HotCache`, instantiated by the server (see :py:class:`vt_server.VTServer`). If ``None``, there is no hot cache.
+HOT_CACHE = None
+
+class WorkerPool():
+    """
+    A pool of pre-started worker processes that run the jobs.
+
+    :param n_workers: The number of worker processes.
+    :param queue_size: The maximum number of jobs that can be pending (queued or running)
+        in the pool at any given time.
+
+    If a worker dies unexpectedly (the pool is then said to be *broken*), the pool is restarted
+    on the next submission.
+    """
+
+    def __init__(self, n_workers, queue_size):
+        self.n_workers = n_workers
+        self.queue_size = queue_size
+        self.n_pending = 0
+        self.lock = Lock()
+        self.executor = None
+        self.start()
+
+    def start(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.n_workers, initializer=init_worker, initargs=(vsc.CONFIG, list(vsm.MODULES.keys())))
+        # Workers are started on the first submission, so we submit a dummy job to have them ready
+        self.executor.submit(os.getpid).result()
+        vsl.LOG.info("Started a worker pool with %d worker(s) and a queue of %d jobs." % (self.n_workers, self.queue_size))
+
+    def submit(self, fn, *args):
+        """
+        Submits ``fn(*args)`` to the pool.
+
+        :return: A :py:class:`concurrent.futures.Future`, or ``None`` if the queue is full.
+        """
+        with self.lock:
+            if self.n_pending >= self.queue_size:
+                vsl.LOG.warning("The job queue is full (%d jobs pending)." % self.n_pending)
+                return None
+            try:
+                fut = self.executor.submit(fn, *args)
+            except BrokenProcessPool:
+                vsl.LOG.error("The worker pool is broken, we restart it.")
+                self.executor.shutdown(wait=False)
+                self.start()
+                fut = self.executor.submit(fn, *args)
+            self.n_pending += 1
+        fut.add_done_callback(self.job_done)
+        return fut
+
+    def job_done(self, fut):
+        with self.lock:
+            self.n_pending -= 1
+
+    def kill(self):
+        vsl.LOG.debug("Shutting down the worker pool...")
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+#: The pool of worker processes, instantiated by the server (see :py:class:`vt_server.VTServer`).
+#: If it is ``None``, jobs are run in the calling process.
+WORKER_POOL = None
+
+#: This is ``True`` in the worker processes of the :py:data:`WORKER_POOL`.
+IN_WORKER = False
+
+#: The futures of the jobs being processed, by job signature. Their result is the response of the job,
+#: and all the queries for the same job are attached to them.
+JOB_FUTURES = dict()
+
+#: Protects :py:data:`JOBS` and :py:data:`JOB_FUTURES`.
+JOBS_LOCK = Lock()
+
+class ResponseFuture(Future):
+    """
+    A :py:class:`concurrent.futures.Future` whose result is a response.
+
+    :param timeout: How long (in seconds) the client is willing to wait for the response. ``None`` means forever.
+    :param timeout_response: The response that is sent instead if the result is not ready before the timeout.
+    """
+
+    def __init__(self, timeout=None, timeout_response=None):
+        super().__init__()
+        self.timeout = timeout
+        self.timeout_response = timeout_response
+
+    def response(self):
+        """
+        Waits for the response, or for the timeout.
+        """
+        try:
+            return self.result(self.timeout)
+        except FutureTimeoutError:
+            return self.timeout_response
+
+def init_worker(config, module_names):
+    """
+    Initializes a worker process of the :py:class:`WorkerPool`. Sub-queries met
+    by a worker are run in the worker itself rather than being submitted to the pool,
+    and are tracked in the worker's own :py:data:`JOBS` list.
+
+    :param config: The server configuration, in case the worker does not inherit it.
+    :param module_names: The modules available on the server. If the worker does not
+        have them, it discovers them.
+    """
+    global IN_WORKER, HOT_CACHE, CLAIM_KEEPER
+    IN_WORKER = True
+    HOT_CACHE = None
+    CLAIM_KEEPER = None
+    JOBS.clear()
+    JOB_FUTURES.clear()
+    vsc.CONFIG.update(config)
+    if any([k not in vsm.MODULES for k in module_names]):
+        vsm.discover_modules()
+
 def job_signature(req):
+    """
+    The signature of the query **req** (or of a file name). Source files are identified by
+    their fingerprint (see :py:func:`vt_server_common_tools.source_fingerprint`).
+    """
 
     if isinstance(req, dict):
         if isinstance(req['file'], list):
-            return 'M'+vsct.signature(([job_signature(x) for x in req['file']], req['stack']))
+            return 'M'+vsct.signature(([job_signature(x) for x in req['file']], stack_signature(req['stack'])))
         elif isinstance(req['file'], dict):
-            return 'S'+vsct.signature((job_signature(req['file']), req['stack']))
+            return 'S'+vsct.signature((job_signature(req['file']), stack_signature(req['stack'])))
         else:
-            return vsct.signature((os.path.abspath(req['file']), req['stack']))
+            return vsct.signature((vsct.source_fingerprint(req['file']), stack_signature(req['stack'])))
     else:
         # req is a filename
-        return vsct.signature((os.path.abspath(req), []))
+        return vsct.signature((vsct.source_fingerprint(req), []))
+
+def stack_signature(stack):
+    """
+    What identifies the **stack** in the signature of a query: the modules of the stack (see :py:func:`module_signature`),
+    and the options of the configuration the modules of the stack depend on, if any (see :py:func:`module_options`).
+    """
+    options = dict()
+    for m in stack:
+        options.update(module_options(m))
+    stack = [module_signature(m) for m in stack]
+    if len(options)==0:
+        return stack
+    return (stack, options)
+
+def module_signature(m):
+    """
+    What identifies module **m** in signatures: the module itself, where the **file** it takes as argument, if it is
+    a path, is replaced by the fingerprint of the file (see :py:func:`vt_server_common_tools.source_fingerprint`).
+    """
+    if not isinstance(m, dict) or not isinstance(m.get('file'), str):
+        return m
+    try:
+        return dict(m, file=vsct.source_fingerprint(m['file']))
+    except OSError:
+        # The file does not exist, the module will report it
+        return m
+
+def module_options(m):
+    """
+    The options of the configuration the output of module **m** depends on (the `CONFIG_KEYS` of the
+    module, see :py:mod:`vt_server_modules`), as a `dict`.
+    """
+    if not isinstance(m, dict) or m.get('module') not in vsm.MODULES:
+        return dict()
+    return {k: vsc.CONFIG.get(k) for k in vsm.MODULES[m['module']].config_keys}
 
 # def _job_signature_multi(files, stack):
 #     signs = list()
@@ -162,17 +580,14 @@ class QueryInType(IntEnum):
     GENERATOR = 2
     LIST = 3
 
-def process(req, force_sync=False):
+def check_request(req):
     """
-    Creates jobs (populating the :py:data:`JOBS` list), checks on cache and dispatches processing threads.
+    Checks the query **req** and fills in the default values of the optional fields. This
+    has to be done before calling :py:func:`job_signature`.
 
-    :param req: The query received by the server.
-    :type req: dict
+    :return: ``None`` if the query is valid, or an error response.
     """
 
-    global N_REQUESTS
-    N_REQUESTS += 1
-
     if 'mode' not in req:
         req['mode'] = 'async'
     if req['mode'] not in ['sync', 'async', 'hash']:
@@ -193,6 +608,11 @@ def process(req, force_sync=False):
     if 'cache' not in req:
         req['cache'] = 730
 
+    if 'timeout' not in req:
+        req['timeout'] = None
+    elif req['timeout'] is not None and (not isinstance(req['timeout'], (int, float)) or req['timeout']<0):
+        return {'out': 'error', 'details':  "The 'timeout' field has to be a positive number of seconds: %s." % repr(req['timeout'])}
+
     if req['cache'] is False:
         req['cache'] = (datetime.datetime.now() + datetime.timedelta(hours=1), 1)
     elif isinstance(req['cache'], (int, float)) and req['cache']>=0:
@@ -235,6 +655,58 @@ def process(req, force_sync=False):
     #         return {'out': 'error', 'details': "Cannot have a list of stacks (with more than one stack) when passing in a single file."}
     #     req['stack'] = req['stack'][0]
 
+    return None
+
+def process(req, force_sync=False):
+    """
+    Creates jobs (populating the :py:data:`JOBS` list), checks on cache and submits the jobs
+    to the :py:data:`WORKER_POOL`.
+
+    This is the blocking version of :py:func:`submit`: it waits for the job to be done if the
+    query is in `sync` mode.
+
+    :param req: The query received by the server.
+    :type req: dict
+
+    :param force_sync: If ``True``, waits for the job to be finished whatever the `mode` of the query.
+    :type force_sync: bool
+
+    :return: The response as a `dict` with fields `out` and `details`.
+    """
+
+    o = submit(req, force_sync)
+    if isinstance(o, ResponseFuture):
+        return o.response()
+    return o
+
+def submit(req, force_sync=False):
+    """
+    Same as :py:func:`process`, but does not wait for the job to be done. If the job is
+    run in `sync` mode (or if **force_sync** is ``True``), or if a **timeout** is set for an `async` query, a
+    :py:class:`ResponseFuture` is returned instead of the response. Its result is the response once the job is done.
+
+    :param req: The query received by the server.
+    :type req: dict
+
+    :param force_sync: If ``True``, the response will be the outcome of the job whatever the `mode` of the query.
+    :type force_sync: bool
+
+    :return: The response as a `dict`, or a :py:class:`ResponseFuture`.
+    """
+
+    global N_REQUESTS
+    with JOBS_LOCK:
+        # Queries are submitted from several threads
+        N_REQUESTS += 1
+
+    err = check_request(req)
+    if err is not None:
+        return err
+
+    sweep = sweep_points(req)
+    if sweep is not None:
+        return submit_sweep(req, *sweep, force_sync)
+
     #----------------------------
     # From here on, we are ready to call job_signature
 
@@ -245,216 +717,635 @@ def process(req, force_sync=False):
     if req['mode'] == 'hash':
         return {'out': 'ok', 'details': h}
 
-    out_path = os.path.join(os.path.abspath(vsc.CONFIG['cachefolder']), h[0])
-    out_filename = os.path.join(out_path, h+"."+req['format'])
+    # Jobs are identified by their output file: the same query in another format is another job
+    h = h+"."+req['format']
 
-    if not os.path.exists(out_path):
-        os.makedirs(out_path)
+    out_path = os.path.join(os.path.abspath(vsc.CONFIG['cachefolder']), h[0])
+    out_filename = os.path.join(out_path, h)
 
-    if os.access(out_filename, os.R_OK):
-        # The file already exists and is accessible, we return it
-        vsl.LOG.debug("[%s] Found %s in cache. Done." % (h, out_filename))
-        try:
-            vsct.update_job_file(out_filename)
-        except:
-            vsl.LOG.warning("[%s] Something went wrong while updating the job-file associated with %s" % (h,out_filename))
+    if HOT_CACHE is not None and out_filename in HOT_CACHE:
+        # Deleted files are removed from the hot cache (see HotCache), so we do not check the file
+        vsl.LOG.debug("[%s] Found %s in the hot cache. Done." % (h, out_filename))
+        vsct.update_job_file(out_filename)
         return {"out": "ok", "details": out_filename}
-    else:
-        if h in JOBS:
-            # The job is already being processed
-            if JOBS[h]['finished']:
+
+    new_job = False
+    with JOBS_LOCK:
+        # Checking for a running job and registering a new one is atomic, so that
+        # identical queries always end up attached to the same job.
+        job = JOB_FUTURES.get(h)
+        if job is not None:
+            vsl.LOG.debug('[%s] Job is being processed, attaching to it' % h)
+        else:
+            if os.access(out_filename, os.R_OK):
+                # The file already exists and is accessible, we return it
+                vsl.LOG.debug("[%s] Found %s in cache. Done." % (h, out_filename))
+                try:
+                    vsct.update_job_file(out_filename)
+                except:
+                    vsl.LOG.warning("[%s] Something went wrong while updating the job-file associated with %s" % (h,out_filename))
+                if HOT_CACHE is not None:
+                    HOT_CACHE.add(out_filename)
+                return {"out": "ok", "details": out_filename}
+
+            if not os.path.exists(out_path):
+                os.makedirs(out_path)
+
+            if h in JOBS and JOBS[h]['finished']:
                 if JOBS[h]['out']!='ok':
                     return {"out": JOBS[h]['out'], "details": JOBS[h]['details']}
                 else:
                     # Job is marked finished and ok, but cache couldn't be accessed, we need to regenerate it
                     vsl.LOG.info("[%s] Found job in JOBS, started at %s, marked finished and ok, but cache (%s) couldn't be accessed, we need to regenerate it" % (h, JOBS[h]['started_at'].strftime("%m/%d/%Y, %H:%M:%S"), out_filename))
-                    JOBS.pop(h)
-            else:
-                vsl.LOG.debug('[%s] Found job in JOBS, started at %s, not finished yet' % (h ,JOBS[h]['started_at'].strftime("%m/%d/%Y, %H:%M:%S")));
-                return {"out": "wait", "details": "Job started at %s" % JOBS[h]['started_at'].strftime("%m/%d/%Y, %H:%M:%S")}
 
-        vsl.LOG.debug("[%s] Adding job to the JOBS list." % h)
+            vsl.LOG.debug("[%s] Adding job to the JOBS list." % h)
 
-        JOBS[h] = {'finished': False, 'started_at': datetime.datetime.now(), 'pid': None}
+            JOBS[h] = {'finished': False, 'started_at': datetime.datetime.now()}
+            job = JOB_FUTURES[h] = Future()
+            new_job = True
 
-        # if req['in_type'] == QueryInType.QUERY:
-        #     vsl.LOG.debug("[%s] Starting sub-query process." % (h))
-        #     p = Process(target=subquery_process_async, args=(req, h, out_filename))
-        # else:
-        if req['in_type'] == QueryInType.LIST:
-            proc_target = multi_process_async
+    if new_job:
+        if CLAIM_KEEPER is None or CLAIM_KEEPER.claim(h):
+            start_job(req, h, out_filename, job)
         else:
-            proc_target = process_async
+            vsl.LOG.debug('[%s] Job is being processed by another server, waiting for it' % h)
+            CLAIM_KEEPER.wait(req, h, out_filename, job)
 
-        p = Process(target=proc_target, args=(req, h, out_filename))
+    return attach_to_job(h, job, req, force_sync)
 
-        p.start()
+def sweep_points(req):
+    """
+    Finds the first module of the stack of query **req** that makes a sweep, i.e. that has parameters that make a sweep
+    (see :py:mod:`vt_server_modules`) given as lists of values.
 
-        j = JOBS[h]
-        j['pid'] = p.pid
-        JOBS[h] = j
+    :return: ``None`` if the query is not a sweep, or a tuple ``(i, ms)`` with the index of the module in the stack, and
+        the list of the module parameters for each point of the sweep (all the combinations of values).
+    """
 
-        vsl.LOG.debug("[%s] Job is running in process %d." % (h, p.pid))
+    for i, m in enumerate(req['stack']):
+        if not isinstance(m, dict) or m.get('module') not in vsm.MODULES:
+            continue
+        keys = [k for k in vsm.MODULES[m['module']].sweep_keys if isinstance(m.get(k), list)]
+        if len(keys)==0:
+            continue
+        ms = list()
+        for values in itertools.product(*[m[k] for k in keys]):
+            p = copy.deepcopy(m)
+            p.update(zip(keys, values))
+            ms.append(p)
+        return i, ms
+
+    return None
+
+def submit_sweep(req, i, ms, force_sync=False):
+    """
+    Processes the sweep query **req** (see :py:func:`sweep_points`). The query is split into one query per point of the
+    sweep, whose module **i** has the parameters listed in **ms**, and these queries are processed as a batch (see :py:func:`submit_many`).
+    Before that, the module is run once for all the points of the sweep (see :py:func:`sweep_async`), in a job of its own:
+    the queries of the batch then find the output of the module in the cache, and only process the rest of the stack.
 
-        if req['mode']=='async' and not force_sync:
-            return {"out": "wait", "details": "Job started at %s" % JOBS[h]['started_at'].strftime("%m/%d/%Y, %H:%M:%S")}
-        elif req['mode']=='sync' or force_sync:
-            p.join()
-            j = JOBS[h]
-            if 'out' in j:
-                output = {"out": j['out'], "details": j['details']}
-                JOBS.pop(h)
-                return output
+    :return: Same as :py:func:`submit_many`. In `async` mode, the `'wait'` response is returned until all the points are done.
+    """
+
+    queries = list()
+    for m in ms:
+        q = copy.deepcopy(req)
+        q['stack'][i] = m
+        queries.append(q)
+    batch = {'queries': queries, 'mode': 'sync' if force_sync else req['mode']}
+
+    if req['mode']=='hash' or req['in_type']==QueryInType.LIST or len(queries)==0:
+        return submit_many(batch)
+
+    out_filenames = list()
+    for q in queries:
+        hq = job_signature(q)
+        out_filenames.append(os.path.join(os.path.abspath(vsc.CONFIG['cachefolder']), hq[0], hq+"."+req['format']))
+    if all([os.access(f, os.R_OK) for f in out_filenames]):
+        return submit_many(batch)
+
+    h = 'W'+job_signature(req)+"."+req['format']
+
+    # The future of the sweep is set once all the points are done, so the sweep is only processed once
+    new_job = False
+    with JOBS_LOCK:
+        sweep = JOB_FUTURES.get(h)
+        if sweep is not None:
+            vsl.LOG.debug('[%s] Sweep is being processed, attaching to it' % h)
+        else:
+            if h in JOBS and JOBS[h]['finished'] and JOBS[h]['out']!='ok':
+                # The points that failed have no file, the sweep would be processed again
+                return {"out": JOBS[h]['out'], "details": JOBS[h]['details']}
+            JOBS[h] = {'finished': False, 'started_at': datetime.datetime.now()}
+            sweep = JOB_FUTURES[h] = Future()
+            new_job = True
+
+    if new_job:
+        vsl.LOG.info("[%s] Processing sweep of %d points: %s" % (h, len(queries), req))
+
+        def batch_done(o):
+            try:
+                if isinstance(o, Future):
+                    o = o.result()
+            except Exception as err:
+                o = job_failed(h, err)
+            finish_job(h, sweep, o)
+
+        def module_done(job):
+            try:
+                o = job.result()
+                if o['out']=='busy':
+                    job_rejected(h, sweep, o)
+                    return
+                if o['out']!='ok':
+                    vsl.LOG.warning("[%s] The sweep failed, the points will be processed separately: %s" % (h, o['details']))
+                # The points are submitted in sync mode to know when they are all done
+                o = submit_many({'queries': copy.deepcopy(queries), 'mode': 'sync'})
+            except Exception as err:
+                finish_job(h, sweep, job_failed(h, err))
+                return
+            if isinstance(o, Future):
+                o.add_done_callback(batch_done)
             else:
-                return {'out': 'error', 'details': "Not sure what happened here... JOB=%s" % repr(j)}
+                batch_done(o)
+
+        # The job running the module for all the points is not registered: it is part of the sweep
+        job = Future()
+        job.add_done_callback(module_done)
+        run_job(h+"/"+ms[0]['module'], job, sweep_async, req, h, i, ms)
+
+    return attach_to_job(h, sweep, req, force_sync)
+
+def start_job(req, h, out_filename, job):
+    """
+    Runs job **h** in the :py:data:`WORKER_POOL` (or in the current process if there is no pool, or if
+    we are already in a worker). The result of the future **job** is set to the response of the job when
+    it is done.
+
+    When the job is run in the pool, the sub-queries it depends on (see :py:func:`job_dependencies`) are
+    submitted first, as jobs of their own. Since sub-queries are themselves started with this function, a query is
+    expanded into a graph of jobs, in which shared sub-queries are only processed once (they have the same signature),
+    and all the jobs that are ready are processed in parallel. The job itself is run once all its sub-queries
+    are done: it then finds their results in the cache. No worker is kept waiting for a sub-query.
+    """
+
+    # if req['in_type'] == QueryInType.QUERY:
+    #     vsl.LOG.debug("[%s] Starting sub-query process." % (h))
+    #     p = Process(target=subquery_process_async, args=(req, h, out_filename))
+    # else:
+    if req['in_type'] == QueryInType.LIST:
+        proc_target = multi_process_async
+    else:
+        proc_target = process_async
+
+    if IN_WORKER or WORKER_POOL is None:
+        # The sub-queries will be processed by the job itself
+        run_job(h, job, proc_target, req, h, out_filename)
+        return
+
+    deps = list()
+    for q in job_dependencies(req):
+        try:
+            deps.append(submit(q, True))
+        except Exception as err:
+            deps.append({'out': 'error', 'details': "Sub-query %s could not be processed: %s" % (repr(q), repr(err))})
+
+    if len(deps)>0:
+        vsl.LOG.debug("[%s] Submitted the %d sub-queries of the job." % (h, len(deps)))
+
+    def deps_done(deps):
+        for out in ['busy', 'error']:
+            failed = [o for o in deps if o['out']==out]
+            if len(failed)>0:
+                vsl.LOG.debug("[%s] A sub-query of the job was not processed: %s" % (h, failed[0]['details']))
+                if out=='busy':
+                    job_rejected(h, job, failed[0])
+                else:
+                    finish_job(h, job, failed[0])
+                return
+        run_job(h, job, proc_target, req, h, out_filename)
+
+    when_all(deps, deps_done)
+
+def job_dependencies(req):
+    """
+    Lists the sub-queries that the job for query **req** depends on: the query (or queries) given as **file**,
+    and the queries given as **file** to the modules of the **stack**. The sub-queries are returned as the job
+    will run them, so they have the same signature.
+    """
+
+    files = list()
+    if req['in_type'] == QueryInType.QUERY:
+        files.append(req['file'])
+    elif req['in_type'] == QueryInType.LIST and not os.access(multi_concatenated_filename(req), os.R_OK):
+        files.extend([f for f in req['file'] if isinstance(f, dict)])
+
+    deps = list()
+    for f in files:
+        r = copy.deepcopy(f)
+        r['format'] = vsc.CONFIG['cacheformat']
+        r['format_options'] = vsc.CONFIG['cacheformatoptions']
+        deps.append(r)
+
+    for m in req['stack']:
+        if isinstance(m, dict) and isinstance(m.get('file'), dict):
+            q = copy.deepcopy(m['file'])
+            q['mode'] = 'sync'
+            deps.append(q)
+
+    return deps
+
+def run_job(h, job, fn, *args):
+    """
+    Runs ``fn(*args)``, the function processing job **h**, in the :py:data:`WORKER_POOL` (or in the current process
+    if there is no pool, or if we are already in a worker). See :py:func:`start_job`.
+    """
+
+    if IN_WORKER or WORKER_POOL is None:
+        # This is a sub-query processed by a worker, or there is no pool: we run the job here
+        vsl.LOG.debug("[%s] Job is running in process %d." % (h, os.getpid()))
+        fut = Future()
+        try:
+            fut.set_result(fn(*args))
+        except Exception as err:
+            fut.set_exception(err)
+    else:
+        fut = WORKER_POOL.submit(worker_job, fn, *args)
+
+        if fut is None:
+            job_rejected(h, job, {"out": "busy", "details": "The job queue is full (%d jobs pending), try again later." % WORKER_POOL.queue_size})
+            return
+
+        vsl.LOG.debug("[%s] Job was submitted to the worker pool." % (h))
+
+    fut.add_done_callback(lambda fut: job_done(h, fut, job))
+
+def worker_job(fn, *args):
+    """
+    Runs ``fn(*args)`` in a worker of the :py:data:`WORKER_POOL`, and then records the accesses to cache files
+    made during the job in the cache index.
+    """
+    try:
+        return fn(*args)
+    finally:
+        try:
+            vsct.flush_job_files()
+        except Exception as err:
+            vsl.LOG.error("Something went wrong while recording the accesses to the cache files: %s" % repr(err))
+
+def when_all(outputs, callback):
+    """
+    Calls ``callback(outputs)`` once all the items of the list **outputs** that are futures have been replaced
+    by their result. If there is no future in the list, **callback** is called right away.
+    """
+
+    pending = [i for i, o in enumerate(outputs) if isinstance(o, Future)]
+    if len(pending)==0:
+        callback(outputs)
+        return
+
+    lock = Lock()
+    def item_done(i, fut):
+        with lock:
+            outputs[i] = fut.result()
+            pending.remove(i)
+            done = len(pending)==0
+        if done:
+            callback(outputs)
+    for i in list(pending):
+        outputs[i].add_done_callback(lambda fut, i=i: item_done(i, fut))
+
+def submit_many(req):
+    """
+    Processes a batch of queries (`"process_many"` action). The queries are listed in
+    the **queries** field of **req**. Identical queries (with the same signature and format) are only submitted once,
+    and all the jobs are submitted to the :py:data:`WORKER_POOL` at once.
+
+    The **mode** of the batch (`"async"` by default) applies to all the queries, overriding their own.
+
+    :return: A response whose `details` is the list of the responses for each query, in the same order
+        as the queries, and whose `out` is `"error"` if any of the queries failed, `"busy"` if any was
+        turned down, `"wait"` if any is still being processed, and `"ok"` otherwise. In `sync` mode, a
+        :py:class:`ResponseFuture` of this response is returned.
+    """
+
+    if 'queries' not in req or not isinstance(req['queries'], list):
+        return {'out': 'error', 'details': "The 'queries' field is missing or is not a list."}
+
+    if 'mode' not in req:
+        req['mode'] = 'async'
+    if req['mode'] not in ['sync', 'async', 'hash']:
+        return {'out': 'error', 'details': "'mode' has to be 'sync', 'async' or 'hash' ('%s' provided)" % (req['mode'])}
+
+    outputs = list()
+    signatures = dict()
+    for i, q in enumerate(req['queries']):
+        if not isinstance(q, dict):
+            outputs.append({'out': 'error', 'details': "Query %d is not an object." % i})
+            continue
+        q['mode'] = req['mode']
+        q['timeout'] = None
+        try:
+            err = check_request(q)
+            if err is not None:
+                outputs.append(err)
+                continue
+            h = job_signature(q)+"."+q['format']
+            if h not in signatures:
+                signatures[h] = submit(q, req['mode']=='sync')
+            outputs.append(signatures[h])
+        except Exception as err:
+            outputs.append({'out': 'error', 'details': "Query %d could not be processed: %s" % (i, repr(err))})
+
+    vsl.LOG.info("Batch of %d queries submitted as %d jobs." % (len(req['queries']), len(signatures)))
+
+    if not any([isinstance(o, Future) for o in outputs]):
+        return batch_output(outputs)
+
+    res = ResponseFuture()
+    when_all(outputs, lambda outputs: res.set_result(batch_output(outputs)))
+    return res
+
+def batch_output(outputs):
+    """
+    Gathers the responses of a batch of queries into a single response (see :py:func:`submit_many`).
+    """
+    for out in ['error', 'busy', 'wait']:
+        if any([o['out']==out for o in outputs]):
+            return {'out': out, 'details': outputs}
+    return {'out': 'ok', 'details': outputs}
+
+def job_done(h, fut, job):
+    """
+    Called when the future **fut** of the worker running job **h** is done. The response returned by the worker is stored
+    in the :py:data:`JOBS` list, and set as result of **job**, the future all the queries for this job are attached to.
+    If the job raised an exception in the worker, the job is marked as failed.
+    """
+    err = fut.exception()
+    if err is not None:
+        output = job_failed(h, err)
+    else:
+        output = fut.result()
+        if not isinstance(output, dict) or 'out' not in output:
+            output = {'out': 'error', 'details': "The job returned an unexpected output: %s" % repr(output)}
+    finish_job(h, job, output)
+
+def finish_job(h, job, output):
+    """
+    Marks job **h** as finished with the response **output** in the :py:data:`JOBS` list, and sets it as result of **job**.
+    """
+    with JOBS_LOCK:
+        if JOB_FUTURES.get(h) is job:
+            JOB_FUTURES.pop(h)
+        if h in JOBS and not JOBS[h]['finished']:
+            JOBS[h].update(out=output['out'], details=output['details'], finished=True)
+    if CLAIM_KEEPER is not None:
+        CLAIM_KEEPER.release(h)
+    if HOT_CACHE is not None and output['out']=='ok' and isinstance(output['details'], str):
+        HOT_CACHE.add(output['details'])
+    job.set_result(output)
+
+def job_rejected(h, job, output):
+    """
+    Removes job **h**, that could not be run, from the :py:data:`JOBS` list and sets the response **output**
+    (typically a `'busy'` response) as result of **job**.
+    """
+    with JOBS_LOCK:
+        JOBS.pop(h, None)
+        if JOB_FUTURES.get(h) is job:
+            JOB_FUTURES.pop(h)
+    if CLAIM_KEEPER is not None:
+        CLAIM_KEEPER.release(h)
+    job.set_result(output)
+
+def attach_to_job(h, job, req, force_sync=False):
+    """
+    Returns the response to query **req** for job **h**, whose future is **job**.
+
+    If the job is done, its response is returned. Otherwise, in `async` mode, the `'wait'` response
+    is returned (see :py:func:`wait_for_job`), and in `sync` mode (or if **force_sync** is ``True``)
+    a :py:class:`ResponseFuture` whose result will be the response of the job.
+    """
+    if job.done():
+        return job_output(h, job)
+    if req['mode']=='async' and not force_sync:
+        return wait_for_job(h, req['timeout'])
+    res = ResponseFuture()
+    job.add_done_callback(lambda job: res.set_result(job_output(h, job)))
+    return res
+
+def job_output(h, job, pop=True):
+    """
+    Returns the response of job **h**, whose future **job** is done.
+
+    :param pop: If ``True``, the job is removed from the :py:data:`JOBS` list.
+    """
+    output = job.result()
+    if pop:
+        with JOBS_LOCK:
+            if h in JOBS and JOBS[h]['finished']:
+                JOBS.pop(h)
+    return output
+
+def wait_response(h):
+    """
+    The `'wait'` response for job **h**.
+    """
+    j = JOBS.get(h)
+    if j is None:
+        return {"out": "wait", "details": "Job is being processed"}
+    return {"out": "wait", "details": "Job started at %s" % j['started_at'].strftime("%m/%d/%Y, %H:%M:%S")}
+
+def wait_for_job(h, timeout):
+    """
+    Returns the response to an `async` query for job **h**, which is not finished.
+
+    :param timeout: How long the client accepts to wait for the job (in seconds). If ``None`` or 0, or if
+        the job is not running, the `'wait'` response is returned right away. Otherwise, a
+        :py:class:`ResponseFuture` is returned: its result is set as soon as the job is done, and
+        if that takes longer than **timeout**, the `'wait'` response should be sent instead.
+    """
+    job = JOB_FUTURES.get(h)
+    if not timeout or job is None:
+        return wait_response(h)
+    res = ResponseFuture(timeout, wait_response(h))
+    job.add_done_callback(lambda job: res.set_result(job_output(h, job, False)))
+    return res
+
+def job_failed(h, err):
+    """
+    Returns the error response of job **h**, when the job function raised
+    exception **err** instead of reporting the error itself.
+    """
+    vsl.LOG.critical("[%s] The job raised an exception: %s" % (h, repr(err)))
+    return {'out': 'error', 'details': "The job failed with error: %s" % repr(err)}
 
 def cast_outfile(f, out_filename, req, h):
+    """
+    Writes the final output file **out_filename** of job **h** from the last file **f** of its stack.
+
+    :return: ``None``, or an error response if the file could not be written.
+    """
 
     vsl.LOG.debug("[%s] Casting `%s` into `%s`" % (h, f, out_filename))
 
+    tmp_filename = vsct.temporary_filename(out_filename)
+
     if os.path.splitext(f)[1] == os.path.splitext(out_filename)[1]:
-        os.symlink(f, out_filename)
+        os.symlink(f, tmp_filename)
+        os.replace(tmp_filename, out_filename)
         vsct.job_file(out_filename, [f], req['cache'], req['stack'])
     else:
         if req['format'] == 'mp3':
             try:
-                encode_to_format(f, out_filename, req['format'], req['format_options'])
+                encode_to_format(f, tmp_filename, req['format'], req['format_options'])
+                os.replace(tmp_filename, out_filename)
                 vsct.job_file(out_filename, [f], req['cache'], req['stack'])
             except Exception as err:
                 err_msg = "Encoding of '%s' to format '%s' failed with error: %s, %s" % (f, req['format'], err, err.output.decode('utf-8'))
-                j = JOB[h]
-                j['out'] = 'error'
-                j['details'] = err_msg
-                j['finished'] = True
-                JOBS[h] = j
                 vsl.LOG.critical(err_msg)
-                return False
+                return {'out': 'error', 'details': err_msg}
         else:
             x, fs = sf.read(f)
-            sf.write(out_filename, x, fs)
-            vsct.job_file(out_filename, [f], req['cache'], req['stack'])
+            content = vsct.write_sound(out_filename, x, fs)
+            vsct.job_file(out_filename, [f], req['cache'], req['stack'], content=content)
 
-    return True
+    return None
 
 def process_async(req, h, out_filename):
     """
     This is the function that is threaded to run the core of the module. It dispatches
     calls to the appropriate modules, and deals with their cache.
 
-    It also updates the :py:data:`JOB` list when a job is finished, and create a job file
-    with some information about the job (useful for cache cleaning).
+    It returns the response of the job (a `dict` with fields `out` and `details`), which the server
+    stores in the :py:data:`JOBS` list when the job is finished. The files created by the job
+    are recorded in the cache index (see :py:func:`vt_server_common_tools.cache_index`) with the files
+    they were made from, and their cache expiration (useful for cache cleaning).
 
-    If a module takes a `'file'` as argument, the file can be a query. It will be executed in sync mode from the
-    current :py:func:`process_async` process.
+    If a module takes a `'file'` as argument, the file can be a query. Such sub-queries are normally already in the cache:
+    when the job is run in the :py:data:`WORKER_POOL`, they are submitted as jobs of their own before it (see
+    :py:func:`start_job`). They are only run here, in sync mode, as a fallback: when the job is itself a sub-query run in a
+    worker, when there is no pool, or when their output was removed in the meantime.
 
-    Job files are pickled `dict` objects that contain the following fields:
+    """
 
-        original_file `[string]`
-            The original sound file that the job was based on.
+    vsl.LOG.debug("[%s] Processing request %s." % (h, repr(req)))
+
+    f, j = process_input(req, h)
+    if j is not None:
+        return j
+
+    # job_info = dict()
+    # job_info['source_files'] = [f] # If source file does not exist anymore, the job is deleted
+    # job_info['support_files'] = list() # Additional files that need deleting if source file is missing, but not if there is simple cache expiration
+    # job_info['stack'] = req['stack']
+    # job_info['cache_expiration'] = req['cache']
+    # job_filename = os.path.splitext(out_filename)[0]+".job"
 
-        created_files `[list]`
-            The list of files that were created in the process. This includes the final
-            sound file, but also intermediate files that may have been necessary to the
-            process.
+    f, j = process_stack(req, h, f)
+    if j is not None:
+        return j
 
-        used_files `[list]`
-            If an intermediate file was used, but not created by the current job, it is listed here.
+    j = cast_outfile(f, out_filename, req, h)
+    if j is None:
+        j = {'out': 'ok', 'details': out_filename}
+        vsl.LOG.debug("[%s] Finished with processing the stack." % (h))
 
-        stack `[dict]`
-            The stack that defines the job.
+    return j
 
-        cache_expiration `[tuple(datetime, float)]` `optional`
-            If `None` or missing, the cache does not expire by itself. Otherwise, the field contains
-            a date after which the `created_files` can be removed, and a time-delta in hours. Everytime the
-            file is accessed, the cache expiration is updated with the time-delta.
+def sweep_async(req, h, i, ms):
+    """
+    Processes the sweep of query **req** (job **h**, see :py:func:`submit_sweep`): the stack is run up to module **i**,
+    and the sweep function of the module is then called for all the points of the sweep, whose module parameters are
+    listed in **ms** (see :py:func:`process_module_sweep`).
 
+    :return: The response of the job, whose `details` is the list of the outputs of the module for each point.
     """
 
-    vsl.LOG.debug("[%s] Processing request %s." % (h, repr(req)))
+    vsl.LOG.debug("[%s] Processing sweep %s." % (h, repr(req)))
 
-    j = JOBS[h]
+    f, j = process_input(req, h)
+    if j is None:
+        f, j = process_stack(req, h, f, i)
+    if j is not None:
+        return j
+
+    try:
+        files = process_module_sweep(f, ms, req['format'], req['cache'])
+    except Exception as err:
+        err_msg = "Something went wrong while running the sweep of module '%s' on file '%s': %s" % (ms[0]['module'], f, traceback.format_exc())
+        vsl.LOG.critical(err_msg)
+        return {'out': 'error', 'details': err_msg}
+
+    vsl.LOG.debug("[%s] Finished with processing the sweep." % (h))
+    return {'out': 'ok', 'details': files}
+
+def process_input(req, h):
+    """
+    Gets the input file of query **req** (for job **h**): this is the **file** of the query, or the output of
+    the sub-query given as **file**, which is normally already in the cache (see :py:func:`process_async`), and
+    is otherwise run in sync mode.
+
+    :return: A tuple ``(f, j)`` with the input file, and an error response, or ``None`` if there was no error.
+    """
 
     # TODO: handle generators for file
     if req['in_type'] == QueryInType.FILE:
-        f = req['file']
+        return req['file'], None
     elif req['in_type'] == QueryInType.QUERY:
         r = req['file']
         r['format'] = vsc.CONFIG['cacheformat']
         r['format_options'] = vsc.CONFIG['cacheformatoptions']
         o = process(r, force_sync=True)
         if o['out']=='error':
-            j = JOBS[h]
-            j['out'] = 'error'
-            j['details'] = o['details']
-            j['finished'] = True
-            JOBS[h] = j
+            j = {'out': 'error', 'details': o['details']}
             vsl.LOG.debug("[%s] There was an error while processing the subquery: %s" % (h, j['details']))
-            return
+            return None, j
         else:
-            f = o['details']
+            return o['details'], None
     elif req['in_type'] == QueryInType.GENERATOR:
-        j = JOBS[h]
-        j['out'] = 'error'
-        j['details'] = "Generators are not supported yet (%s)." % req['file']
-        j['finished'] = True
-        JOBS[h] = j
+        j = {'out': 'error', 'details': "Generators are not supported yet (%s)." % req['file']}
         vsl.LOG.debug("[%s] %s" % (h, j['details']))
-        return
+        return None, j
 
+def process_stack(req, h, f, stop=None):
+    """
+    Runs the modules of the stack of query **req** (for job **h**) on the file **f**, up to item **stop**
+    (excluded) of the stack, or up to the end of the stack if **stop** is ``None``.
 
-    # job_info = dict()
-    # job_info['source_files'] = [f] # If source file does not exist anymore, the job is deleted
-    # job_info['support_files'] = list() # Additional files that need deleting if source file is missing, but not if there is simple cache expiration
-    # job_info['stack'] = req['stack']
-    # job_info['cache_expiration'] = req['cache']
-    # job_filename = os.path.splitext(out_filename)[0]+".job"
+    :return: A tuple ``(f, j)`` with the cache file of the output of the last module, and an error response,
+        or ``None`` if there was no error.
+    """
 
-    for i, m in enumerate(req['stack']):
+    sound = None # The output of the previous module, if it was kept in memory
+    for i, m in enumerate(req['stack'][:stop]):
 
         if 'module' not in m:
             err_msg = "Item %d of the stack does not have a 'module' defined: %s" % (i, repr(m))
-            j = JOBS[h]
-            j['out'] = 'error'
-            j['details'] = err_msg
-            j['finished'] = True
-            JOBS[h] = j
+            j = {'out': 'error', 'details': err_msg}
             vsl.LOG.critical(err_msg)
-            return
+            return f, j
 
         vsl.LOG.debug("[%s] Doing module '%s'" % (h, m['module']))
         if m['module'] in vsm.MODULES:
             try:
-                f = process_module(f, m, req['format'], req['cache'])
+                # If we stop before the end of the stack, the last output is always written
+                f, sound = process_module(f, m, req['format'], req['cache'], sound, i+1==stop or is_checkpoint(req['stack'], i))
                 vsl.LOG.debug("[%s] Done with module '%s'" % (h, m['module']))
 
             except Exception as err:
                 #err_msg = "Something went wrong while running module '%s' on file '%s': %s" % (m['module'], f, repr(err))
                 err_msg = "Something went wrong while running module '%s' on file '%s': %s" % (m['module'], f, traceback.format_exc())
-                j = JOBS[h]
-                j['out'] = 'error'
-                j['details'] = err_msg
-                j['finished'] = True
-                JOBS[h] = j
+                j = {'out': 'error', 'details': err_msg}
                 vsl.LOG.critical(err_msg)
-                return
+                return f, j
         else:
             err_msg = "Calling unknown module '%s' while processing '%s'." % (m['module'], f)
-            j = JOBS[h]
-            j['out'] = 'error'
-            j['details'] = err_msg
-            j['finished'] = True
-            JOBS[h] = j
+            j = {'out': 'error', 'details': err_msg}
             vsl.LOG.critical(err_msg)
-            return
+            return f, j
 
-    if cast_outfile(f, out_filename, req, h):
-        j = JOBS[h]
-        j['out'] = 'ok'
-        j['details'] = out_filename
-        j['finished'] = True
-        JOBS[h] = j
-
-        vsl.LOG.debug("[%s] Finished with processing the stack." % (h))
+    return f, None
 
 # def subquery_process_async(req, h, out_filename):
 #
@@ -578,21 +1469,34 @@ def process_async(req, h, out_filename):
 #         else:
 #             return {'out': 'error', 'details': "Not sure what happened here... JOB=%s" % repr(j)}
 
+def multi_concatenated_filename(req):
+    """
+    The cache file where the concatenation of the files of multi-file query **req** is stored.
+    """
+    r = req.copy()
+    r['stack'] = []
+    hc = job_signature(r)
+    return os.path.join(os.path.abspath(vsc.CONFIG['cachefolder']), '_multi_', hc[0], hc+"."+vsc.CONFIG['cacheformat'])
+
 def multi_process_async(req, h, out_filename):
+    """
+    Processes a multi-file query: the files (or sub-queries) of the list are concatenated, and the
+    stack is applied to the concatenated file.
+
+    The sub-queries of the list are normally already in the cache: when the job is run in the :py:data:`WORKER_POOL`,
+    they are submitted as jobs of their own, and processed in parallel, before it (see :py:func:`start_job` and
+    :py:func:`job_dependencies`). The loop below, which runs them one after the other in sync mode, is only a fallback
+    (see :py:func:`process_async`).
+    """
 
     vsl.LOG.debug("[%s] Starting multi_process_async..." % (h))
 
-    r = req.copy()
-    r['stack'] = []
-    hc = job_signature(r)
-    concatenated_path = os.path.join(os.path.abspath(vsc.CONFIG['cachefolder']), '_multi_', hc[0])
-    concatenated_filename = os.path.join(concatenated_path, hc+"."+vsc.CONFIG['cacheformat'])
+    concatenated_filename = multi_concatenated_filename(req)
+    concatenated_path = os.path.dirname(concatenated_filename)
 
     if not os.path.exists(concatenated_path):
         os.makedirs(concatenated_path)
 
-    j = JOBS[h]
-
     if os.access(concatenated_filename, os.R_OK):
         # The file already exists and is accessible, we skip creation
         vsl.LOG.debug("[%s] Found concatenated file '%s' in cache." % (h, concatenated_filename))
@@ -609,13 +1513,9 @@ def multi_process_async(req, h, out_filename):
             elif isinstance(f, str): # This is a file
                 o.append( {'out': 'ok', 'details': f} )
             else:
-                j = JOBS[h]
-                j['out'] = 'error'
-                j['details'] = "Element %d of multi-query is of unhandled type (%s)." % (i, type(f))
-                j['finished'] = True
-                JOBS[h] = j
+                j = {'out': 'error', 'details': "Element %d of multi-query is of unhandled type (%s)." % (i, type(f))}
                 vsl.LOG.debug("[%s] Element %d of multi-query is of unhandled type (%s)." % (h, i, type(f)))
-                return
+                return j
 
         # if any([x['out']=='error' for x in o]):
         #     j['out'] = 'error'
@@ -656,40 +1556,29 @@ def multi_process_async(req, h, out_filename):
                 except Exception as e:
                     err = "Error while reading %s...\n%s" % (oj['details'],e)
                     vsl.LOG.debug("[%s] %s" % (h, err))
-                    j = JOBS[h]
-                    j['out'] = 'error'
-                    j['details'] = err
-                    j['finished'] = True
-                    JOBS[h] = j
+                    j = {'out': 'error', 'details': err}
                     vsl.LOG.debug("[%s] Job is done!" % (h))
-                    return
+                    return j
 
                 if y is None:
                     y = x
                     fs_y = fs
                 else:
                     if fs!=fs_y:
-                        j = JOBS[h]
-                        j['out'] = 'error'
-                        j['details'] = 'Mismatching sampling frequencies between ['+oj['details']+'] and ['+(", ".join([x['details'] for x in o if x['details']!=oj['details']]))+'])'
-                        j['finished'] = True
-                        JOBS[h] = j
+                        j = {'out': 'error', 'details': 'Mismatching sampling frequencies between ['+oj['details']+'] and ['+(", ".join([x['details'] for x in o if x['details']!=oj['details']]))+'])'}
                         vsl.LOG.debug("[%s] File `%s` has a mismatching sampling frequency (%d instead of %d)..." % (h, oj['details'], fs, fs_y))
-                        return
+                        return j
 
                     y = np.concatenate((y, x), axis=0)
 
             vsl.LOG.debug("[%s] Writing out concatenated sounds to `%s`..." % (h, concatenated_filename))
-            sf.write(concatenated_filename, y, fs_y)
+            content = vsct.write_sound(concatenated_filename, y, fs_y)
+            vsct.job_file(concatenated_filename, [oj['details'] for oj in o], req['cache'], None, content=content)
 
         else:
-            j = JOBS[h]
-            j['out'] = 'error'
-            j['details'] = "There was an error when processing one of the subqueries."
-            j['finished'] = True
-            JOBS[h] = j
+            j = {'out': 'error', 'details': "There was an error when processing one of the subqueries."}
             vsl.LOG.debug("[%s] There was an error when processing one of the subqueries." % (h))
-            return
+            return j
 
 
     r = req.copy()
@@ -697,25 +1586,30 @@ def multi_process_async(req, h, out_filename):
     o = process(r, True)
 
     if o['out']!='ok':
-        j = JOBS[h]
-        j['out'] = o['out']
-        j['details'] = o['details']
-        j['finished'] = True
-        JOBS[h] = j
+        j = {'out': o['out'], 'details': o['details']}
         vsl.LOG.debug("[%s] Multi-job failed on concatenated file!" % (h))
-        return
-
-    if cast_outfile(o['details'], out_filename, req, h):
-        j = JOBS[h]
-        j['out'] = 'ok'
-        j['details'] = out_filename
-        j['finished'] = True
-        JOBS[h] = j
+        return j
 
+    j = cast_outfile(o['details'], out_filename, req, h)
+    if j is None:
+        j = {'out': 'ok', 'details': out_filename}
         vsl.LOG.debug("[%s] Multi-job is done!" % (h))
 
+    return j
+
+
+def is_checkpoint(stack, i):
+    """
+    Tells if the output of item **i** of the **stack** has to be written in the cache. Modules that
+    have an array-level function (see :py:mod:`vt_server_modules`) are chained in memory, so their
+    output is only written if this is the last item of the stack, or if the next module only works on files.
+    """
+    if i+1 >= len(stack):
+        return True
+    m = stack[i+1]
+    return not isinstance(m, dict) or m.get('module') not in vsm.MODULES or vsm.MODULES[m['module']].array_function is None
 
-def process_module(f, m, format, cache=None):
+def process_module(f, m, format, cache=None, sound=None, checkpoint=True):
     """
     Applying a single module and managing the job-file.
 
@@ -728,18 +1622,19 @@ def process_module(f, m, format, cache=None):
     :param cache: The cache expiration policy (either None, by default, or a tuple with a
         date and a number of hours).
 
+    :param sound: If the output of the previous module was kept in memory, a tuple ``(x, fs, source_files)``
+        with the sound, its sampling frequency, and the files it was made from. **f** is then the cache file
+        the sound would have been written to. Otherwise ``None``.
+
+    :param checkpoint: If ``False`` and the module has an array-level function, the output is kept in memory
+        instead of being written in the cache (see :py:func:`is_checkpoint`).
+
+    :return: A tuple ``(f, sound)`` with the cache file of the output, and the output itself if it was kept
+        in memory (``None`` otherwise).
+
     """
     # Do we have this already in cache?
-    hm = vsct.signature((os.path.abspath(f), m))
-    module_cache_path = os.path.join(os.path.abspath(vsc.CONFIG['cachefolder']), m['module'])
-    if format=='mp3':
-        # We save in wav first, and will convert to mp3 at the end
-        cache_filename = os.path.join(module_cache_path, hm+".wav")
-    else:
-        cache_filename = os.path.join(module_cache_path, hm+"."+vsc.CONFIG['cacheformat'])
-
-    if not os.path.exists(module_cache_path):
-        os.makedirs(module_cache_path)
+    cache_filename = module_cache_filename(f, m, format)
 
     if os.access(cache_filename, os.R_OK):
         try:
@@ -748,6 +1643,7 @@ def process_module(f, m, format, cache=None):
             vsl.LOG.warning("Something went wrong while updating the job-file associated with %s: %s" % (cache_filename, err))
 
         f = cache_filename
+        sound = None
     else:
         if 'file' in m and type(m['file'])==type(dict()):
             # This is a module that takes a file as argument, and the file is a query
@@ -763,15 +1659,37 @@ def process_module(f, m, format, cache=None):
         # Calling the right module
         source_files = list()
 
+        if vsm.MODULES[m['module']].array_function is not None and (sound is not None or not checkpoint):
+            if sound is None:
+                x, fs = sf.read(f)
+                source_files = [f]
+            else:
+                x, fs, source_files = sound
+            y, fs = vsm.MODULES[m['module']].array_function(x, fs, m)
+            if 'file' in m:
+                source_files = source_files + [m['file']]
+            if not checkpoint:
+                return cache_filename, (y, fs, source_files)
+            content = vsct.write_sound(cache_filename, y, fs)
+            vsct.job_file(cache_filename, source_files, cache, m, content=content)
+            return cache_filename, None
+
+        # The module writes in a temporary file that is moved in place once it is complete
+        tmp_filename = vsct.temporary_filename(cache_filename)
+
         if vsm.MODULES[m['module']].type == 'modifier':
-            o = vsm.MODULES[m['module']](f, m, cache_filename)
+            o = vsm.MODULES[m['module']](f, m, tmp_filename)
             source_files = [f]
 
         elif vsm.MODULES[m['module']].type == 'generator':
-            o, sources_files = vsm.MODULES[m['module']](f, m, cache_filename)
+            o, sources_files = vsm.MODULES[m['module']](f, m, tmp_filename)
             if sources_files is None:
                 sources_files = []
 
+        if o == tmp_filename:
+            os.replace(tmp_filename, cache_filename)
+            o = cache_filename
+
         if 'file' in m:
             source_files.append(m['file'])
 
@@ -779,7 +1697,60 @@ def process_module(f, m, format, cache=None):
 
         f = o
 
-    return f
+    return f, None
+
+def module_cache_filename(f, m, format):
+    """
+    Returns the cache file of the output of the module with parameters **m** applied to file **f**, when
+    the sound needs to be generated in **format** (see :py:func:`process_module`).
+    """
+    options = module_options(m)
+    if len(options)==0:
+        hm = vsct.signature((vsct.source_fingerprint(f), module_signature(m)))
+    else:
+        hm = vsct.signature((vsct.source_fingerprint(f), module_signature(m), options))
+    module_cache_path = os.path.join(os.path.abspath(vsc.CONFIG['cachefolder']), m['module'])
+    if format=='mp3':
+        # We save in wav first, and will convert to mp3 at the end
+        cache_filename = os.path.join(module_cache_path, hm+".wav")
+    else:
+        cache_filename = os.path.join(module_cache_path, hm+"."+vsc.CONFIG['cacheformat'])
+
+    if not os.path.exists(module_cache_path):
+        os.makedirs(module_cache_path)
+
+    return cache_filename
+
+def process_module_sweep(f, ms, format, cache=None):
+    """
+    Applies the sweep function of a module (see :py:mod:`vt_server_modules`) to the file **f**, for all the points of
+    the sweep, whose module parameters are listed in **ms**. The output for each point is stored in the cache file where
+    :py:func:`process_module` would have stored it, so the points that are already in the cache are skipped.
+
+    The other parameters are the same as for :py:func:`process_module`.
+
+    :return: The list of the cache files of the outputs.
+    """
+
+    module = vsm.MODULES[ms[0]['module']]
+    cache_filenames = [module_cache_filename(f, m, format) for m in ms]
+
+    todo = [k for k, c in enumerate(cache_filenames) if not os.access(c, os.R_OK)]
+    if len(todo)==0:
+        return cache_filenames
+
+    # The module writes in temporary files that are moved in place once they are complete
+    tmp_filenames = [vsct.temporary_filename(cache_filenames[k]) for k in todo]
+    outputs = module.sweep_function(f, [copy.deepcopy(ms[k]) for k in todo], tmp_filenames)
+
+    for k, tmp_filename, o in zip(todo, tmp_filenames, outputs):
+        if o == tmp_filename:
+            os.replace(tmp_filename, cache_filenames[k])
+            o = cache_filenames[k]
+        vsct.job_file(o, [f], cache, ms[k])
+        cache_filenames[k] = o
+
+    return cache_filenames
 
 def encode_to_format(in_filename, out_filename, fmt, fmt_options):
     """
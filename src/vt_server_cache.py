@@ -6,20 +6,22 @@ Cache clean-up
 ==============
 
 The cache can become big and obsolete, so it is a good idea to clean it up regularly.
-In particular, if the original file does not exist anymore, all the processed files
-should be removed.
+In particular, if the original file does not exist anymore, or if it was replaced by a new
+version, all the processed files should be removed.
 
-For that, we use the job file that is created by the :py:mod:`vt_server_brain`.
-The job file lists all the files that were created (or used) during a specific job.
-If no job file exist for a specific cache file, we erase it. Note, that we may be
-missing cache files from individual modules with this approach.
+For that, we use the cache index (see :py:func:`vt_server_common_tools.cache_index`)
+that is filled by the :py:mod:`vt_server_brain` and the modules. The index lists all the files that were
+created in the cache, with the files they were made from, and when they expire. Cleaning up the cache is
+therefore a matter of querying the index, rather than going through the whole cache folder. At level 1,
+the cache folder is also scoured for files that are not in the index, which are then erased.
 
 The :py:mod:`vt_server_cache` module has a command line interface so you can easily
 put it in your crontab.
 
 .. code-block:: text
 
-    usage: vt_server_cache.py [-h] [-l LEVEL] [-s] [folder]
+    usage: vt_server_cache.py [-h] [-l LEVEL] [-s] [-m MAX_SIZE] [-j THREADS]
+                              [-c CHECKPOINT] [-q] [-p {lru,lfu}] [folder]
 
     positional arguments:
       folder                The cache folder to cleanse. If none is provided, we
@@ -30,9 +32,29 @@ put it in your crontab.
       -l LEVEL, --level LEVEL
                             Level of cleansing [default 0]. 0 will remove all
                             files created by jobs that are related to files that
-                            do not exist anymore. 1996 will remove *ALL* files
-                            from the cache.
+                            do not exist anymore. 1 will also remove files that
+                            are not in the cache index. 1996 will remove *ALL*
+                            files from the cache.
       -s, --simulate        Will not do anything, but will show what it would do.
+      -m MAX_SIZE, --max-size MAX_SIZE
+                            Also removes the least used files if the cache is
+                            bigger than this size (in MB).
+      -j THREADS, --threads THREADS
+                            The number of threads used to check the files
+                            [default 1].
+      -c CHECKPOINT, --checkpoint CHECKPOINT
+                            A file where the progress of the cleanup is saved,
+                            so that an interrupted cleanup can be resumed.
+      -q, --quiet           Only prints errors.
+      -p {lru,lfu}, --policy {lru,lfu}
+                            The policy used to choose the files to remove when
+                            the cache is too big: 'lru' (least recently used) or
+                            'lfu' (least frequently used) [default 'lru'].
+
+When the server runs with a `maxcachesize` in its configuration, the same eviction is
+done periodically by the server itself (see :py:func:`evict_cache`). Similarly, with a `cleanupinterval`,
+the server cleans up its cache itself, one batch of the cache index at a time (see :py:func:`cleanup_cache_batch`
+and :py:class:`vt_server_brain.CacheCleaner`), so that no cron job is needed.
 
 The cache cleaning procedure is described below.
 
@@ -43,20 +65,32 @@ The cache cleaning procedure is described below.
 
 import vt_server_config as vsc
 #import vt_server_logging as vsl
+import vt_server_common_tools as vsct
 
-import os, pickle, time, datetime
+import os, pickle, time, datetime, json, heapq
+from concurrent.futures import ThreadPoolExecutor
 
-def delete_file(f, simulate, cache_folder=None, silent=False, indent=0):
+#: Functions called with the path of every file that is removed from the cache by this module
+#: (used by the server to keep its :py:class:`vt_server_brain.HotCache` up to date).
+ON_DELETE = list()
+
+def deleted(f):
+    for fn in ON_DELETE:
+        fn(f)
+
+def delete_file(f, simulate, cache_folder=None, silent=False, indent=0, verbose=True):
 
     if cache_folder is not None:
         fn = f.replace(cache_folder, '{cache}', 1)
     else:
         fn = f
 
-    print("   "+("   "*indent)+"[Deleting] "+fn)
+    if verbose:
+        print("   "+("   "*indent)+"[Deleting] "+fn)
     if not simulate:
         try:
             os.remove(f)
+            deleted(f)
             return True
         except Exception as err:
             if not silent:
@@ -83,23 +117,144 @@ def spooky_cleanup_cache(fold, simulate, indent=0, cache_folder=None):
 
 
 
-def cleanup_cache(fold=None, level=0, simulate=False):
+def delete_job(target, simulate, cache_folder, verbose=True):
+    """
+    Deletes the file **target** and its entry in the cache index.
+    """
+    if os.path.lexists(target):
+        delete_file(target, simulate, cache_folder, verbose=verbose)
+    if not simulate:
+        vsct.cache_index_execute("DELETE FROM jobs WHERE target = ?", (target,), cache_folder)
+
+def file_mtime(f):
+    """
+    The modification time of **f**, or ``None`` if the file does not exist.
+    """
+    try:
+        return os.stat(f).st_mtime
+    except OSError:
+        return None
+
+def check_files(files, known, n_threads=1):
+    """
+    Checks which of **files** exist, and when they were modified. The modification times (or ``None`` for missing
+    files) are stored in the `dict` **known**, and files that are already in **known** are not checked again: the
+    many files that are made from the same source file only cost one check.
+
+    :param n_threads: The number of threads used to check the files.
+    """
+
+    todo = [f for f in set(files) if f not in known]
+    if n_threads>1 and len(todo)>1:
+        with ThreadPoolExecutor(n_threads) as executor:
+            known.update(zip(todo, executor.map(file_mtime, todo)))
+    else:
+        known.update([(f, file_mtime(f)) for f in todo])
+
+#: The number of entries of the cache index that are checked at once by :py:func:`cleanup_cache_batch`.
+CLEANUP_BATCH_SIZE = 1000
+
+def cleanup_cache_batch(fold, after, simulate, known, n_threads=1, batch_size=CLEANUP_BATCH_SIZE, verbose=True):
+    """
+    Checks the :py:data:`CLEANUP_BATCH_SIZE` entries of the cache index that come after the target **after**
+    (in alphabetical order). Files whose cache has expired are deleted, as well as files for which one of the
+    source files does not exist any more, or was modified after the file was made (source files from outside the
+    cache only, see :py:func:`vt_server_common_tools.source_fingerprint`). Entries whose file does not exist any
+    more are removed from the index.
+
+    :param fold: The (absolute) cache folder.
+    :param after: The target after which to start, ``''`` to start from the beginning.
+    :param known: A `dict` of the modification times of the files that were already checked (see :py:func:`check_files`).
+        Deleted files are marked as missing, so that the files that were made from them are deleted too.
+
+    :return: The last target that was checked (``None`` if there was nothing left to check) and the number
+        of files that were deleted.
+    """
+
+    rows = vsct.cache_index_execute("SELECT target, sources, expiration, created FROM jobs WHERE target > ? ORDER BY target LIMIT ?", (after, batch_size), fold).fetchall()
+    if len(rows)==0:
+        return None, 0
+
+    rows = [(target, json.loads(sources), expiration, created) for target, sources, expiration, created in rows]
+    check_files([target for target, _, _, _ in rows] + [f for _, sources, _, _ in rows for f in sources], known, n_threads)
+
+    now = time.time()
+    n_deleted = 0
+    for target, sources, expiration, created in rows:
+
+        if expiration is not None and expiration < now:
+            if verbose:
+                print("%s:" % target.replace(fold, '{cache}', 1))
+                print("   Cache expired on %s." % datetime.datetime.fromtimestamp(expiration))
+            delete_job(target, simulate, fold, verbose)
+            known[target] = None
+            n_deleted += 1
+            continue
+
+        if known[target] is None:
+            if not simulate:
+                vsct.cache_index_execute("DELETE FROM jobs WHERE target = ?", (target,), fold)
+            continue
+
+        # Files that are hard links to identical files are older than their entry
+        if created is None:
+            created = known[target]
+        all_there = all([known[f] is not None for f in sources])
+        modified = [f for f in sources if all_there and not f.startswith(fold+os.path.sep) and known[f] > created]
+
+        if verbose:
+            print("%s:" % target.replace(fold, '{cache}', 1))
+
+            if expiration is None:
+                cache_date = 'never expires'
+            else:
+                cache_date = str(datetime.datetime.fromtimestamp(expiration))
+
+            print("   Cache is not expired ("+cache_date+").")
+
+            source_file_list = "".join(["\n      "+("[ ] " if known[f] is None else "[M] " if f in modified else "[X] ")+f.replace(fold, "{cache}", 1) for f in sources])
+            if not all_there:
+                print("   Some source files are missing:" + source_file_list)
+            elif len(modified)>0:
+                print("   Some source files were modified:" + source_file_list)
+            else:
+                print("   All source files still exist:" + source_file_list)
+                print("   [Keeping]")
+
+        if not all_there or len(modified)>0:
+            delete_job(target, simulate, fold, verbose)
+            known[target] = None
+            n_deleted += 1
+
+    return rows[-1][0], n_deleted
+
+def cleanup_cache(fold=None, level=0, simulate=False, verbose=True, n_threads=1, checkpoint=None):
     """
     The function that cleans up the cache. The **level** argument is used to specify
     how spooky clean you want your cache:
 
-    * 0 is the standard (and default) level, it will scoure the cache folder for
-      generated files. If a file does not have an eponym .job file, it will be deleted.
-      Otherwise, the job file is opened, and, if the original sound file does not exist
-      any more, all files listed as "created" are deleted. The final sound file
-      (or symlinks) created are deleted as well as the job file.
+    * 0 is the standard (and default) level, it will go through the cache index (see
+      :py:func:`vt_server_common_tools.cache_index`) by batches (see :py:func:`cleanup_cache_batch`).
+      Files whose cache has expired are deleted. Otherwise, if one of the source files of a file does
+      not exist any more, the file is deleted. Entries of the index whose file does not exist any more
+      are removed. Deleting a file may orphan the files that were made from it, so we go through the
+      index again until nothing is deleted.
+
+    * 1 does the same, and also scours the cache folder for files that are not in the index.
+      These files are deleted if they are older than 2 min. Job files left by older versions
+      of the server are imported in the index before that.
 
     * 1996 will make your cache spooky clean by eliminating all files (but preserving
       the directory structure).
 
+    :param verbose: If `False`, nothing is printed.
+    :param n_threads: The number of threads used to check the files and to scour the cache folder.
+    :param checkpoint: A file where the progress is saved after each batch. If the cleanup is interrupted, the next
+        cleanup with the same **checkpoint** resumes where it stopped. The file is removed once the cleanup is done.
+
     """
 
-    if simulate:
+    if simulate and verbose:
         print("\n!! We are simulating !!\n")
 
     if fold is None:
@@ -107,108 +262,220 @@ def cleanup_cache(fold=None, level=0, simulate=False):
 
     fold = os.path.abspath(fold)
 
-    print("Scanning cache folder [%s]...\n" % fold)
+    if verbose:
+        print("Scanning cache folder [%s]...\n" % fold)
 
     if level>=1996:
         print("We are running in SPOOKY CLEAN mode!\n")
         return spooky_cleanup_cache(fold, simulate)
 
-    # lst = os.scandir(fold)
+    if level>=1:
+        scan_cache_folder(fold, simulate, verbose, n_threads)
+
+    after = ''
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            after = json.load(f)['after']
+        if verbose:
+            print("Resuming after %s.\n" % after.replace(fold, '{cache}', 1))
+
+    known = dict()
+    n_deleted = 0
+    while True:
+        after, n = cleanup_cache_batch(fold, after, simulate, known, n_threads, verbose=verbose)
+        n_deleted += n
+        if after is None:
+            if n_deleted==0 or simulate:
+                break
+            # Some files were deleted, we go again
+            after = ''
+            n_deleted = 0
+        if checkpoint is not None:
+            with open(checkpoint+".tmp", 'w') as f:
+                json.dump({'after': after}, f)
+            os.replace(checkpoint+".tmp", checkpoint)
+
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
 
-    found_job_files = list()
-    scanned_job_files = list()
+    return 0
 
-    for root, dirs, files in os.walk(fold):
+def scan_cache_folder(fold, simulate, verbose=True, n_threads=1):
+    """
+    Scours the cache folder **fold** for files that are not in the cache index, and deletes them
+    if they are older than 2 min. Job files from older versions are imported in the index, and deleted.
+    The subfolders of **fold** are scoured in parallel by **n_threads** threads.
+    """
 
+    for root, dirs, files in os.walk(fold):
         for fn in files:
-
             f = os.path.join(root, fn)
             fe, ext = os.path.splitext(f)
 
             if ext == ".job":
-                found_job_files.append(f)
+                try:
+                    job = pickle.load(open(f, "rb"))
+                    if os.path.lexists(job['target_file']) and vsct.read_job_file(job['target_file'], fold) is None:
+                        if verbose:
+                            print("[Importing] Job file "+(f.replace(fold, '{cache}', 1)))
+                        if not simulate:
+                            vsct.cache_index_execute("INSERT OR REPLACE INTO jobs (target, sources, expiration, validity, size, last_access, stack) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (job['target_file'], json.dumps(job['source_files']),
+                                 None if job['cache_expiration'] is None else job['cache_expiration'][0].timestamp(),
+                                 None if job['cache_expiration'] is None else job['cache_expiration'][1],
+                                 os.path.getsize(job['target_file']), os.stat(f).st_mtime,
+                                 None if job['stack'] is None else json.dumps(job['stack'], default=repr)), fold)
+                except Exception as err:
+                    print("[Job] Could not import job file %s: %s" % (f.replace(fold, '{cache}', 1), err))
+                delete_file(f, simulate, fold, verbose=verbose)
+
+    indexed = set([os.path.join(fold, vsct.CACHE_INDEX_FILENAME+x) for x in ['', '-wal', '-shm', '-journal']])
+    indexed.update([target for target, in vsct.cache_index_execute("SELECT target FROM jobs", (), fold).fetchall()])
+
+    def scan(folder, recursive):
+        for entry in os.scandir(folder):
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    scan(entry.path, True)
                 continue
-            else:
+            f = entry.path
+            if f in indexed or os.path.splitext(f)[1]==".job":
+                continue
+            if entry.stat(follow_symlinks=False).st_mtime < time.time() - 120:
+                if verbose:
+                    print("%s:\n   [No-job] File is not in the cache index, and older than 2 min." % f.replace(fold, '{cache}', 1))
+                delete_file(f, simulate, fold, verbose=verbose)
+            elif verbose:
+                print("%s:\n   [No-job] File is not in the cache index, but younger than 2 min.\n   [Keeping] File is too young to be killed." % f.replace(fold, '{cache}', 1))
 
-                print("%s:" % f.replace(fold, '{cache}', 1))
+    scan(fold, False)
+    subfolders = [entry.path for entry in os.scandir(fold) if entry.is_dir(follow_symlinks=False)]
+    with ThreadPoolExecutor(max(n_threads, 1)) as executor:
+        list(executor.map(lambda d: scan(d, True), subfolders))
 
-                job_file = fe+".job"
 
-                try:
-                    scanned_job_files.append(job_file)
-                    job = pickle.load(open(job_file, "rb"))
-                    print("   [Job] Loaded job file "+(job_file.replace(fold, '{cache}', 1)))
+#: Eviction starts when the size of the cache exceeds this fraction of the maximum size...
+EVICTION_HIGH_WATERMARK = .95
+#: ... and stops once the size of the cache is below this fraction of the maximum size.
+EVICTION_LOW_WATERMARK = .85
 
-                except Exception as err:
+def evict_cache(fold=None, max_size=None, policy=None, simulate=False, verbose=True):
+    """
+    Removes files from the cache when its size approaches **max_size** (in MB), so that the disk does
+    not fill up. Files are removed until the cache is back below :py:data:`EVICTION_LOW_WATERMARK` times
+    **max_size**.
 
-                    st = os.stat(f)
-                    if st.st_mtime < time.time() - 120:
-                        print("   [No-job] Cannot open job file, and target older than 2 min. The error was:\n       %s" % str(err))
-                        delete_file(f, simulate, fold)
-                    else:
-                        print("   [No-job] Cannot open job file, but target is younger than 2 min. The error was:\n      %s" % str(err))
-                        print("   [Keeping] File is too young to be killed.")
-
-                    if os.path.isfile(job_file):
-                        delete_file(job_file, simulate, fold, True)
-
-                else:
-                    if'cache_expiration' not in job or job['cache_expiration'] is None or datetime.datetime.now() <= job['cache_expiration'][0]:
-
-                        if job['cache_expiration'] is None:
-                            cache_date = 'never expires'
-                        else:
-                            cache_date = str(job['cache_expiration'][0])
-
-                        print("   Cache is not expired ("+cache_date+").")
-
-                        all_there = True
-                        source_file_list = ""
-
-                        for fs in job['source_files']:
-                            e = os.path.exists(fs)
-                            source_file_list += "\n      "
-                            if e:
-                                source_file_list += "[X] "
-                            else:
-                                source_file_list += "[ ] "
-                            source_file_list += fs.replace(fold, "{cache}", 1)
-                            all_there &= e
-
-                        if all_there:
-                            print("   All source files still exist:" + source_file_list)
-                            print("   [Keeping]")
-                            continue
-                        else:
-                            print("   Some source files are missing:" + source_file_list)
-
-                    else:
-                        print("   Cache expired on %s." % job['cache_expiration'][0])
-
-                    # Some files are missing
-                    delete_file(f, simulate)
-                    delete_file(job_file, simulate)
-
-
-    for f in found_job_files:
-        if f in scanned_job_files:
-            continue
+    Only files that no other file in the cache was made from are removed, in the order given by the **policy**:
+    `'lru'` removes the least recently used first, and `'lfu'` the least frequently used first. Once a file is
+    removed, the files it was made from (module intermediates, WORLD analyses...) can be removed in turn.
 
-        print("Deleting orphan job file: "+f)
-        delete_file(f, simulate)
+    :param max_size: The maximum size of the cache in MB. If ``None``, the `maxcachesize` of the configuration is used.
+    :param policy: `'lru'` or `'lfu'`. If ``None``, the `cacheeviction` of the configuration is used.
 
-    return 0
+    :return: The number of files removed and the number of bytes freed.
+    """
+
+    if fold is None:
+        fold = vsc.CONFIG['cachefolder']
+    if max_size is None:
+        max_size = vsc.CONFIG['maxcachesize']
+    if policy is None:
+        policy = vsc.CONFIG['cacheeviction']
+
+    if max_size is None:
+        return 0, 0
+
+    fold = os.path.abspath(fold)
+    max_size = max_size * 1024**2
+
+    vsct.flush_job_files(fold)
+
+    # Identical files are hard links to the same data, which is only counted once
+    total = vsct.cache_index_execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM jobs GROUP BY COALESCE(content, target))", (), fold).fetchone()[0]
+    if total <= EVICTION_HIGH_WATERMARK * max_size:
+        return 0, 0
+
+    if verbose:
+        print("The cache [%s] is %.1f MB, we need to make some room...\n" % (fold, total/1024**2))
+
+    rows = vsct.cache_index_execute("SELECT target, sources, size, last_access, hits, content FROM jobs", (), fold).fetchall()
+
+    # How many files in the cache were made from each file, and how many files share the same data
+    n_users = dict()
+    n_links = dict()
+    for target, sources, size, last_access, hits, content in rows:
+        for f in json.loads(sources):
+            n_users[f] = n_users.get(f, 0) + 1
+        if content is not None:
+            n_links[content] = n_links.get(content, 0) + 1
+
+    entries = dict()
+    for target, sources, size, last_access, hits, content in rows:
+        if policy=='lfu':
+            key = (hits, last_access)
+        else:
+            key = (last_access, hits)
+        entries[target] = (key, json.loads(sources), size or 0, content)
+
+    heap = [(entries[t][0], t) for t in entries if n_users.get(t, 0)==0]
+    heapq.heapify(heap)
+
+    n_files = 0
+    n_bytes = 0
+    while total > EVICTION_LOW_WATERMARK * max_size and len(heap)>0:
+        key, target = heapq.heappop(heap)
+        _, sources, size, content = entries[target]
+
+        if verbose:
+            print("   [Evicting] "+target.replace(fold, '{cache}', 1))
+        if not simulate:
+            try:
+                if os.path.lexists(target):
+                    os.remove(target)
+                deleted(target)
+            except Exception as err:
+                if verbose:
+                    print(err)
+                continue
+            vsct.cache_index_execute("DELETE FROM jobs WHERE target = ?", (target,), fold)
+
+        n_files += 1
+        if content is not None:
+            n_links[content] -= 1
+            if n_links[content] > 0:
+                # The data is still used by another file
+                size = 0
+        total -= size
+        n_bytes += size
+
+        for f in sources:
+            n_users[f] -= 1
+            if n_users[f]==0 and f in entries:
+                heapq.heappush(heap, (entries[f][0], f))
+
+    if verbose:
+        print("\nRemoved %d files (%.1f MB), the cache is now %.1f MB." % (n_files, n_bytes/1024**2, total/1024**2))
+
+    return n_files, n_bytes
 
 
 if __name__=="__main__":
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument("-l", "--level", help="Level of cleansing [default 0]. 0 will remove all files created by jobs that are related to files that do not exist anymore. 1996 will remove *ALL* files from the cache.", type=int, default=0)
+    parser.add_argument("-l", "--level", help="Level of cleansing [default 0]. 0 will remove all files created by jobs that are related to files that do not exist anymore. 1 will also remove files that are not in the cache index. 1996 will remove *ALL* files from the cache.", type=int, default=0)
     parser.add_argument("-s", "--simulate", help="Will not do anything, but will show what it would do.", action="store_true")
+    parser.add_argument("-m", "--max-size", help="Also removes the least used files if the cache is bigger than this size (in MB).", type=float, default=None)
+    parser.add_argument("-j", "--threads", help="The number of threads used to check the files [default 1].", type=int, default=1)
+    parser.add_argument("-c", "--checkpoint", help="A file where the progress of the cleanup is saved, so that an interrupted cleanup can be resumed.", default=None)
+    parser.add_argument("-q", "--quiet", help="Only prints errors.", action="store_true")
+    parser.add_argument("-p", "--policy", help="The policy used to choose the files to remove when the cache is too big: 'lru' (least recently used) or 'lfu' (least frequently used) [default 'lru'].", choices=['lru', 'lfu'], default='lru')
     parser.add_argument("folder", help="The cache folder to cleanse. If none is provided, we will try to read from the default option file.", default=None, nargs='?')
 
     args = parser.parse_args()
 
-    ret = cleanup_cache(args.folder, args.level, args.simulate)
+    ret = cleanup_cache(args.folder, args.level, args.simulate, not args.quiet, args.threads, args.checkpoint)
+
+    if ret==0 and args.max_size is not None and args.level<1996:
+        evict_cache(args.folder, args.max_size, args.policy, args.simulate, not args.quiet)
 
     exit(ret)
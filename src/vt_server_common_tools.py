@@ -9,15 +9,233 @@ This module contains function that may be useful across other VTServer modules.
 
 """
 
-import pickle, hashlib, os, datetime, base64
+import vt_server_config as vsc
+
+import pickle, hashlib, os, datetime, base64, json, time, sqlite3, io, stat
+from threading import Lock, get_ident
+from collections import OrderedDict
 import numpy as np
 
 def signature(desc):
     return base64.b32encode( hashlib.blake2b(pickle.dumps(desc, 2), digest_size=30).digest() ).decode().lower()
 
-def job_file(target_file, source_files, cache_expiration=None, stack=None, error=None):
+def file_hash(filename):
+    """
+    Returns a hash of the content of **filename**.
+    """
+    h = hashlib.blake2b(digest_size=30)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+#: The maximum number of content hashes kept in memory by :py:func:`source_fingerprint` (the least recently used are dropped).
+CONTENT_HASHES_SIZE = 4096
+
+_CONTENT_HASHES = OrderedDict()
+_CONTENT_HASHES_LOCK = Lock()
+
+def source_fingerprint(filename):
+    """
+    Returns what identifies the source file **filename** in the job signatures. This depends on the
+    `fingerprint` option of the configuration:
+
+        `"path"`
+            Only the absolute path of the file is used. If the file is replaced by another one, the cached
+            files that were made from the old one are still used.
+
+        `"stat"` [default]
+            The path, inode, size and modification time of the file are used. Replacing the file changes the
+            signatures, so new files are produced (and the old ones are removed by the cache clean-up).
+
+        `"content"`
+            The path and a hash of the content of the file are used. The hash is only computed once for
+            a given inode, size and modification time. Touching a file does not change the signatures.
+
+    Files from the cache folder are always identified by their path, as their name is already a signature.
+    """
+
+    filename = os.path.abspath(filename)
+    if vsc.CONFIG['fingerprint']=='path' or filename.startswith(os.path.join(os.path.abspath(vsc.CONFIG['cachefolder']), '')):
+        return filename
+
+    st = os.stat(filename)
+    if vsc.CONFIG['fingerprint']=='content':
+        k = (filename, st.st_ino, st.st_size, st.st_mtime_ns)
+        with _CONTENT_HASHES_LOCK:
+            content = _CONTENT_HASHES.get(k)
+            if content is not None:
+                _CONTENT_HASHES.move_to_end(k)
+        if content is None:
+            content = file_hash(filename)
+            with _CONTENT_HASHES_LOCK:
+                _CONTENT_HASHES[k] = content
+                while len(_CONTENT_HASHES) > CONTENT_HASHES_SIZE:
+                    _CONTENT_HASHES.popitem(last=False)
+        return (filename, content)
+
+    return (filename, st.st_ino, st.st_size, st.st_mtime_ns)
+
+#-----------------------------------------------------
+# Cache index
+#-----------------------------------------------------
+
+#: The name of the cache index database, stored in the cache folder.
+CACHE_INDEX_FILENAME = "cache_index.sqlite"
+
+_CACHE_INDEX = dict()
+_CACHE_INDEX_LOCK = Lock()
+
+def cache_index(cache_folder=None):
     """
-    Creates a job file for the `target_file` specified.
+    Returns a connection to the cache index of **cache_folder** (the `cachefolder` of the configuration by default).
+
+    The cache index is an SQLite database with a `jobs` table that has one row per file created in the cache:
+
+        target `[text]`
+            The absolute path of the file.
+
+        sources `[text]`
+            The JSON list of the source files that were used to produce the file. During cache clean-up,
+            if one of the source files is removed, the target is removed.
+
+        expiration `[real]`
+            The timestamp after which the file can be removed, or `NULL` if the file does not expire by itself.
+
+        validity `[real]`
+            The duration of validity in hours. Everytime the file is accessed, **expiration** is pushed back
+            by this amount. `NULL` if the file does not expire by itself.
+
+        size `[integer]`
+            The size of the file in bytes.
+
+        last_access `[real]`
+            The timestamp of the last time the file was created or accessed.
+
+        hits `[integer]`
+            The number of times the file was accessed from the cache.
+
+        stack `[text]`
+            The JSON stack that defines the job, or `NULL`.
+
+        content `[text]`
+            A hash of the content of the file (see :py:func:`file_hash`), or `NULL` for symbolic links.
+            Files with the same content are hard links to the same data (see :py:func:`link_duplicate`).
+
+        created `[real]`
+            The timestamp of the creation of the entry.
+
+    Each process gets its own connection. The database is in WAL mode, which lets the processes read it while
+    another one writes, but which only works if the cache folder is on a local file system: the servers sharing
+    a cache folder have to be on the same machine.
+    """
+
+    if cache_folder is None:
+        cache_folder = vsc.CONFIG['cachefolder']
+    index_filename = os.path.join(os.path.abspath(cache_folder), CACHE_INDEX_FILENAME)
+
+    k = (os.getpid(), index_filename)
+    with _CACHE_INDEX_LOCK:
+        if k not in _CACHE_INDEX:
+            if not os.path.exists(os.path.dirname(index_filename)):
+                os.makedirs(os.path.dirname(index_filename), exist_ok=True)
+            db = sqlite3.connect(index_filename, timeout=60, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                target TEXT PRIMARY KEY,
+                sources TEXT NOT NULL,
+                expiration REAL,
+                validity REAL,
+                size INTEGER,
+                last_access REAL NOT NULL,
+                stack TEXT,
+                hits INTEGER NOT NULL DEFAULT 0,
+                content TEXT,
+                created REAL)""")
+            columns = [c[1] for c in db.execute("PRAGMA table_info(jobs)")]
+            if 'hits' not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN hits INTEGER NOT NULL DEFAULT 0")
+            if 'content' not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN content TEXT")
+                db.execute("ALTER TABLE jobs ADD COLUMN created REAL")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_expiration ON jobs (expiration)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_content ON jobs (content)")
+            _CACHE_INDEX[k] = db
+        return _CACHE_INDEX[k]
+
+def cache_index_execute(sql, args=(), cache_folder=None):
+    """
+    Executes **sql** on the cache index (see :py:func:`cache_index`) and returns the cursor.
+    """
+    db = cache_index(cache_folder)
+    with _CACHE_INDEX_LOCK:
+        return db.execute(sql, args)
+
+def link_duplicate(target_file, content, size, cache_folder=None):
+    """
+    Replaces `target_file` by a hard link to a file of the cache that has the same **content** hash and **size**,
+    if there is one, so that identical files are only stored once.
+
+    :return: ``True`` if `target_file` is now a link to another file of the cache, ``False`` otherwise.
+    """
+
+    target_file = os.path.abspath(target_file)
+    for other, in cache_index_execute("SELECT target FROM jobs WHERE content = ? AND size = ? AND target != ?", (content, size, target_file), cache_folder).fetchall():
+        tmp_file = temporary_filename(target_file)
+        try:
+            os.link(other, tmp_file)
+        except OSError:
+            # The other file is gone, or the file system does not do hard links
+            continue
+        os.replace(tmp_file, target_file)
+        return True
+    return False
+
+def temporary_filename(filename):
+    """
+    Returns a temporary file name, in the same folder and with the same extension as **filename**, that is unique
+    to the calling thread. Files of the cache are written there first, and then moved to **filename** with
+    :py:func:`os.replace`, which is atomic: a file of the cache either does not exist or is complete, even for
+    other processes sharing the same cache folder.
+    """
+    base, ext = os.path.splitext(filename)
+    return "%s.%d-%d.tmp%s" % (base, os.getpid(), get_ident(), ext)
+
+def write_cache_file(filename, data):
+    """
+    Writes the `bytes` **data** to **filename** (atomically, see :py:func:`temporary_filename`). If the cache
+    already has a file with the same content, **filename** is a hard link to that file instead, and nothing is
+    written (see the `cachededup` option of the configuration).
+
+    :return: The hash of **data**, to be passed to :py:func:`job_file`.
+    """
+
+    content = hashlib.blake2b(data, digest_size=30).hexdigest()
+    if not (vsc.CONFIG['cachededup'] and link_duplicate(filename, content, len(data))):
+        tmp_file = temporary_filename(filename)
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_file, filename)
+    return content
+
+def write_sound(filename, x, fs):
+    """
+    Writes the sound **x** in the cache file **filename** through :py:func:`write_cache_file`. The format is
+    given by the extension of **filename**.
+
+    :return: The hash of the content of the file.
+    """
+
+    import soundfile as sf
+
+    buf = io.BytesIO()
+    sf.write(buf, x, fs, format=os.path.splitext(filename)[1].strip('.').upper())
+    return write_cache_file(filename, buf.getvalue())
+
+def job_file(target_file, source_files, cache_expiration=None, stack=None, error=None, content=None):
+    """
+    Records the `target_file` specified in the cache index (see :py:func:`cache_index`).
 
     :param target_file: The output file that this job file concerns.
 
@@ -27,33 +245,94 @@ def job_file(target_file, source_files, cache_expiration=None, stack=None, error
 
     :param stack: Optionnally a stack can be provided. `None` otherwise.
 
+    :param content: The hash of the content of the file if it is already known (see :py:func:`write_cache_file`).
+        Otherwise, the hash is computed here, and if the cache already has a file with the same content, `target_file`
+        is replaced by a hard link to it (see the `cachededup` option of the configuration).
+
     """
 
-    job_info = dict()
-    job_info['target_file'] = os.path.abspath(target_file)
-    job_info['source_files'] = list(set([os.path.abspath(p) for p in source_files]))
-    job_info['cache_expiration'] = cache_expiration
-    job_info['stack'] = stack
+    if cache_expiration is None:
+        expiration, validity = None, None
+    else:
+        expiration, validity = cache_expiration[0].timestamp(), cache_expiration[1]
+
+    try:
+        st = os.lstat(target_file)
+        size = st.st_size
+    except OSError:
+        size = None
 
-    job_filename = os.path.splitext(target_file)[0]+".job"
+    if content is None and size is not None and stat.S_ISREG(st.st_mode) and vsc.CONFIG['cachededup']:
+        try:
+            content = file_hash(target_file)
+            link_duplicate(target_file, content, size)
+        except OSError:
+            content = None
 
-    with open(job_filename, "wb") as f:
-        pickle.dump(job_info, f)
+    now = time.time()
+    cache_index_execute("INSERT OR REPLACE INTO jobs (target, sources, expiration, validity, size, last_access, stack, content, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (os.path.abspath(target_file), json.dumps(sorted(set([os.path.abspath(p) for p in source_files]))), expiration, validity, size, now,
+         None if stack is None else json.dumps(stack, default=repr), content, now))
+
+_PENDING_ACCESSES = dict()
+_PENDING_ACCESSES_LOCK = Lock()
 
 def update_job_file(target_file):
     """
-    Updates the `target_file` cache expiration date if necessary. Note that `target_file`
-    is not the job file itself, but the file targeted by the job-file.
+    Records an access to `target_file`, so that its cache expiration date, its last access time and its number of hits
+    are updated. To keep cache hits cheap, the accesses are only kept in memory: they are written in the cache index
+    in batches by :py:func:`flush_job_files`. The expiration date is computed from the time of the access, not from
+    the time of the flush.
+    """
+
+    k = os.path.abspath(target_file)
+    with _PENDING_ACCESSES_LOCK:
+        _, hits = _PENDING_ACCESSES.get(k, (None, 0))
+        _PENDING_ACCESSES[k] = (time.time(), hits+1)
+
+def flush_job_files(cache_folder=None):
+    """
+    Writes the accesses recorded by :py:func:`update_job_file` in the cache index, in a single transaction.
+    This is called periodically by the :py:class:`vt_server_brain.Janitor`, and by the workers at the end of
+    each job.
+
+    :return: The number of files whose entry was updated.
     """
 
-    job_filename = os.path.splitext(target_file)[0]+".job"
-    job_info = pickle.load(open(job_filename, 'rb'))
+    global _PENDING_ACCESSES
+    with _PENDING_ACCESSES_LOCK:
+        pending = _PENDING_ACCESSES
+        _PENDING_ACCESSES = dict()
 
-    if job_info['cache_expiration'] is not None:
-        job_info['cache_expiration'] = (datetime.datetime.now() + datetime.timedelta(hours=job_info['cache_expiration'][1]), job_info['cache_expiration'][1])
-        pickle.dump(job_info, open(job_filename, 'wb'))
+    if len(pending)==0:
+        return 0
 
+    db = cache_index(cache_folder)
+    with _CACHE_INDEX_LOCK:
+        db.execute("BEGIN")
+        try:
+            db.executemany("UPDATE jobs SET expiration = CASE WHEN validity IS NULL THEN NULL ELSE ?+validity*3600 END, last_access = MAX(last_access, ?), hits = hits+? WHERE target = ?",
+                [(t, t, hits, k) for k, (t, hits) in pending.items()])
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+
+    return len(pending)
+
+def read_job_file(target_file, cache_folder=None):
+    """
+    Returns the cache index entry of `target_file` as a `dict` (with the fields described in :py:func:`cache_index`),
+    or ``None`` if the file is not in the index.
+    """
 
+    c = cache_index_execute("SELECT * FROM jobs WHERE target = ?", (os.path.abspath(target_file),), cache_folder)
+    row = c.fetchone()
+    if row is None:
+        return None
+    job = dict(zip([d[0] for d in c.description], row))
+    job['sources'] = json.loads(job['sources'])
+    return job
 
 
 
@@ -79,6 +79,56 @@ def read_configuration(config_filename=None):
         config['cacheformatoptions'] = None
         vsl.LOG.warning("Hey watchout, the 'cacheformatoptions' wasn't defined! Setting to default '%s'." % config['cacheformatoptions'])
 
+    if 'workers' not in config:
+        config['workers'] = os.cpu_count() or 1
+        vsl.LOG.warning("Hey watchout, the number of 'workers' wasn't defined! Setting to default %d." % config['workers'])
+
+    if 'queuesize' not in config:
+        config['queuesize'] = 256
+        vsl.LOG.warning("Hey watchout, the 'queuesize' wasn't defined! Setting to default %d." % config['queuesize'])
+
+    if 'hotcachesize' not in config:
+        config['hotcachesize'] = 4096
+        vsl.LOG.warning("Hey watchout, the 'hotcachesize' wasn't defined! Setting to default %d." % config['hotcachesize'])
+
+    if 'hotcachebytes' not in config:
+        config['hotcachebytes'] = 0
+        vsl.LOG.warning("Hey watchout, the 'hotcachebytes' wasn't defined! Setting to default %d." % config['hotcachebytes'])
+
+    if 'worldanalysis' not in config:
+        config['worldanalysis'] = {"dtype": "float64", "f0_method": "dio", "frame_period": 5.0, "fft_size": None, "f0_floor": 71.0, "f0_ceil": 800.0, "chunk_duration": 10.0}
+        vsl.LOG.warning("Hey watchout, the 'worldanalysis' wasn't defined! Setting to default %s." % config['worldanalysis'])
+
+    if 'maxcachesize' not in config:
+        config['maxcachesize'] = None
+        vsl.LOG.warning("Hey watchout, the 'maxcachesize' wasn't defined! Setting to default %s (no limit)." % config['maxcachesize'])
+
+    if 'sharedcache' not in config:
+        config['sharedcache'] = False
+        vsl.LOG.warning("Hey watchout, the 'sharedcache' wasn't defined! Setting to default %s." % config['sharedcache'])
+
+    if 'cachededup' not in config:
+        config['cachededup'] = True
+        vsl.LOG.warning("Hey watchout, the 'cachededup' wasn't defined! Setting to default %s." % config['cachededup'])
+
+    if 'fingerprint' not in config:
+        config['fingerprint'] = "stat"
+        vsl.LOG.warning("Hey watchout, the 'fingerprint' wasn't defined! Setting to default '%s'." % config['fingerprint'])
+    elif config['fingerprint'] not in ['path', 'stat', 'content']:
+        vsl.LOG.warning("The provided 'fingerprint' ('%s') is not valid! Setting to default '%s'." % (config['fingerprint'], 'stat'))
+        config['fingerprint'] = "stat"
+
+    if 'cleanupinterval' not in config:
+        config['cleanupinterval'] = None
+        vsl.LOG.warning("Hey watchout, the 'cleanupinterval' wasn't defined! Setting to default %s (no cleanup by the server)." % config['cleanupinterval'])
+
+    if 'cacheeviction' not in config:
+        config['cacheeviction'] = "lru"
+        vsl.LOG.warning("Hey watchout, the 'cacheeviction' wasn't defined! Setting to default '%s'." % config['cacheeviction'])
+    elif config['cacheeviction'] not in ['lru', 'lfu']:
+        vsl.LOG.warning("The provided 'cacheeviction' ('%s') is not valid! Setting to default '%s'." % (config['cacheeviction'], 'lru'))
+        config['cacheeviction'] = "lru"
+
     return config
 
 #: The dictionary holding the current configuration (used in other modules).
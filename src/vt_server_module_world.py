@@ -46,9 +46,52 @@ If a key is missing (here, **duration**) it is considered as ``None``, which mea
 
     * the absolute duration can be set using ``~`` followed by a value and the ``s`` unit.
 
-Note that in v0.2.8, WORLD is making the sounds 1 frame (5 ms) too long if no duration is specified. If you
+Any of these keys can also be a list of values, to make a sweep: the query then produces one sound for
+each combination of values (see :py:func:`sweep_world`):
+
+.. code-block:: json
+
+    {
+        "module": "world",
+        "f0":     ["-2st", "0st", "+2st"],
+        "vtl":    ["-3.8st", "+3.8st"]
+    }
+
+Note that in v0.2.8, WORLD is making the sounds 1 frame (``frame_period``, 5 ms by default) too long if no duration is specified. If you
 specify the duration, it is generated accurately.
 
+The analysis of each sound file is stored in the cache as :file:`.npy` files that are memory-mapped when the
+same sound is processed again (see :py:func:`load_analysis`). The `worldanalysis` option of the configuration
+controls how the analysis is done and stored (see :py:func:`analysis_options`):
+
+    dtype
+      `"float64"` [default] or `"float32"`. With `"float32"`, the spectral envelope and the aperiodicity map take
+      half the space, at the cost of a small loss of precision.
+
+    f0_method
+      `"dio"` [default] estimates f0 with DIO refined by StoneMask, and `"harvest"` with Harvest. Harvest is
+      more robust (fewer voicing errors), but several times slower.
+
+    frame_period
+      The time between two frames of the analysis, in milliseconds (5 by default). A longer frame period makes
+      the analysis and the synthesis faster, and the analysis smaller.
+
+    fft_size
+      The size of the FFT used for the spectral envelope and the aperiodicity map. If `null` [default], it is
+      chosen by WORLD from the sampling frequency and `f0_floor`.
+
+    f0_floor, f0_ceil
+      The range in which f0 is searched, in Hertz (71 and 800 by default).
+
+    chunk_duration
+      Sounds longer than 1.5 times this duration (in seconds, 10 by default) are split in chunks of about
+      this duration, that are analysed in parallel processes (see :py:func:`analyse` and :py:func:`analysis_pool`). If `null`, sounds are
+      never split. Since the f0 estimators resample the whole signal they are given, the analysis of a sound
+      that was split differs slightly from the analysis of the sound in one go.
+
+All these options are part of the signature of the analysis, and of the queries using the module: changing
+them makes new analyses and new sounds rather than using the ones that are in the cache.
+
 .. Created on 2020-03-20.
 """
 
@@ -56,7 +99,11 @@ import vt_server_config as vsc
 import vt_server_logging as vsl
 import vt_server_common_tools as vsct
 
-import time, os, re, pickle
+import time, os, re, json
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from fractions import Fraction
 
 import numpy as np
 import scipy.interpolate as spi
@@ -155,162 +202,429 @@ def parse_arguments(m):
     return m
 
 
-def process_world(in_filename, m, out_filename):
+#: The default values of the options of the analysis (see :py:func:`analysis_options`).
+ANALYSIS_DEFAULTS = {
+    'dtype': 'float64',
+    'f0_method': 'dio',
+    'frame_period': pyworld.default_frame_period,
+    'fft_size': None,
+    'f0_floor': pyworld.default_f0_floor,
+    'f0_ceil': pyworld.default_f0_ceil,
+    'chunk_duration': 10.
+}
+
+#: The duration of the context (in seconds) analysed on each side of the chunks of a sound (see :py:func:`analyse`).
+CHUNK_MARGIN = .5
+
+#: The pool of processes that analyse the chunks of long sounds (see :py:func:`analysis_pool`).
+ANALYSIS_POOL = None
+ANALYSIS_POOL_LOCK = Lock()
+
+def analysis_options():
+    """
+    Returns the options of the analysis: the `worldanalysis` option of the configuration, completed with
+    the :py:data:`ANALYSIS_DEFAULTS`.
     """
-    Processes the file **in_filename** according to parameters **m**, and stores results in **out_filename**.
 
-    The first step is to analyse the sound file to extract its f0, spectral envelope and
-    aperiodicity map. The results of this operation are cached in a pickle file.
+    options = dict(ANALYSIS_DEFAULTS)
+    options.update(vsc.CONFIG['worldanalysis'])
 
-    The parameters for this module are:
+    if options['f0_method'] not in ['dio', 'harvest']:
+        raise ValueError("[world] The f0 method of the analysis has to be 'dio' or 'harvest' ('%s' provided)." % options['f0_method'])
+    if options['frame_period'] <= 0:
+        raise ValueError("[world] The frame period of the analysis has to be positive (%s provided)." % repr(options['frame_period']))
 
-    :param f0: Either an absolute f0 value in Hertz ``{### Hz}``, a change in semitones ``{### st}`` or a ratio ``{\*###}``.
+    return options
 
-    :param vtl: Same for vocal-tract length (only semitones and ratio).
+def analyse(x, fs, options):
+    """
+    Extracts the f0, spectral envelope and aperiodicity map of the sound **x**, with the analysis **options**
+    (see :py:func:`analysis_options`).
 
-    :param duration: Either an absolute duration in seconds ``{~###s}``, an offset in seconds ``{+/-###s}``, or a ratio ``{\*###}``.
+    Long sounds are split in chunks (see :py:func:`chunk_boundaries`) that are analysed in parallel processes. Each
+    chunk is analysed with :py:data:`CHUNK_MARGIN` seconds of context on each side, and only the frames of the chunk
+    itself are kept, so the analysis has the same frames as if the sound had been analysed in one go. The chunks only
+    depend on the sound and the **options**, not on the number of processors.
 
-    Just to be clear, these parameters must be keys of the dictionary **m**.
+    :return: A tuple ``(f0, sp, ap)``.
+    """
+
+    boundaries = chunk_boundaries(x, fs, options)
+    if len(boundaries)<=2:
+        return analyse_chunk(x, fs, options)
+
+    hop = Fraction(str(options['frame_period'])) * fs / 1000 # The number of samples per frame
+    step = int(hop * hop.denominator) # Boundaries are multiples of this, so they fall on frames
+    margin = int(round(CHUNK_MARGIN*fs/step)) * step
+
+    chunks = list()
+    for a, b in zip(boundaries[:-1], boundaries[1:]):
+        chunks.append((max(a-margin, 0), a, b, min(b+margin, len(x))))
+
+    t1 = time.time()
+    xs = [x[s:e] for s, a, b, e in chunks]
+    pool = analysis_pool()
+    results = None
+    if pool is not None:
+        try:
+            results = list(pool.map(analyse_chunk, xs, [fs]*len(xs), [options]*len(xs)))
+        except BrokenProcessPool:
+            vsl.LOG.error("[world (v%s)] The analysis pool is broken, the chunks are analysed in the worker." % pyworld.__version__)
+            close_analysis_pool()
+    if results is None:
+        results = [analyse_chunk(xc, fs, options) for xc in xs]
+    vsl.LOG.info("[world (v%s)] Analysed %d chunks of %.1f s on average in %.2f ms" % (pyworld.__version__, len(chunks), len(x)/fs/len(chunks), (time.time()-t1)*1e3))
+
+    # Stitching the frames of each chunk
+    f0, sp, ap = list(), list(), list()
+    for k, ((s, a, b, e), (f0_c, sp_c, ap_c)) in enumerate(zip(chunks, results)):
+        i = int((a-s)/hop)
+        j = int((b-s)/hop) if k+1<len(chunks) else len(f0_c)
+        f0.append(f0_c[i:j])
+        sp.append(sp_c[i:j])
+        ap.append(ap_c[i:j])
+
+    return np.concatenate(f0), np.concatenate(sp), np.concatenate(ap)
+
+def cpu_share():
+    """
+    The number of processors available to each worker of the server, which share them: ``cpu_count // workers``
+    (at least 1).
+    """
+    return max((os.cpu_count() or 1) // max(vsc.CONFIG.get('workers') or 1, 1), 1)
+
+def analysis_pool():
+    """
+    Returns the pool of processes that analyse the chunks of long sounds (see :py:func:`analyse`), or ``None`` if the
+    chunks have to be analysed in the current process. The pool of each worker has :py:func:`cpu_share` processes.
+    The pool is created when it is first needed, and reused.
+    """
+    global ANALYSIS_POOL
+    n_processes = cpu_share()
+    if n_processes < 2:
+        return None
+    with ANALYSIS_POOL_LOCK:
+        if ANALYSIS_POOL is None:
+            ANALYSIS_POOL = ProcessPoolExecutor(max_workers=n_processes)
+            vsl.LOG.info("[world (v%s)] Started a pool of %d processes for the analysis of long sounds." % (pyworld.__version__, n_processes))
+        return ANALYSIS_POOL
+
+def close_analysis_pool():
+    """
+    Shuts down the pool of :py:func:`analysis_pool`. A new one is created when it is needed again.
+    """
+    global ANALYSIS_POOL
+    with ANALYSIS_POOL_LOCK:
+        if ANALYSIS_POOL is not None:
+            ANALYSIS_POOL.shutdown(wait=False, cancel_futures=True)
+            ANALYSIS_POOL = None
+
+def chunk_boundaries(x, fs, options):
+    """
+    Returns the sample indices where the sound **x** is split for the analysis (see :py:func:`analyse`), including
+    the beginning and the end of the sound.
+
+    The sound is split in chunks of about `chunk_duration` seconds: each boundary is put at the quietest point
+    within a quarter of `chunk_duration` of the regular split point, and on a frame of the analysis.
+    """
+
+    if not options['chunk_duration'] or len(x) < 1.5*options['chunk_duration']*fs:
+        return [0, len(x)]
+
+    hop = Fraction(str(options['frame_period'])) * fs / 1000
+    step = int(hop * hop.denominator)
+    n_steps = len(x) // step
+    n_chunks = int(round(len(x) / (options['chunk_duration']*fs)))
+    if n_steps < 4*n_chunks:
+        # The frames are too far apart for the boundaries to be placed
+        return [0, len(x)]
+
+    # The energy of the sound between two possible boundaries
+    energy = np.sum(np.reshape(x[:n_steps*step]**2, (n_steps, -1)), axis=1)
+
+    window = int(options['chunk_duration']*fs/4 / step)
+    boundaries = [0]
+    for c in range(1, n_chunks):
+        target = int(c*n_steps/n_chunks)
+        lo = max(target-window, boundaries[-1]//step+1)
+        hi = min(target+window+1, n_steps)
+        boundaries.append((lo + int(np.argmin(energy[lo:hi]))) * step)
+    boundaries.append(len(x))
+
+    return boundaries
+
+def analyse_chunk(x, fs, options):
+    """
+    Extracts the f0, spectral envelope and aperiodicity map of the sound **x** in one go (see :py:func:`analyse`).
+
+    :return: A tuple ``(f0, sp, ap)``.
     """
 
-    # created_files = list()
-    # used_files    = list()
+    if options['f0_method']=='harvest':
+        f0, t = pyworld.harvest(x, fs, f0_floor=options['f0_floor'], f0_ceil=options['f0_ceil'], frame_period=options['frame_period'])
+    else:
+        f0, t = pyworld.dio(x, fs, f0_floor=options['f0_floor'], f0_ceil=options['f0_ceil'], frame_period=options['frame_period'])
+        f0 = pyworld.stonemask(x, f0, t, fs)
+
+    # The spectral envelope and the aperiodicity map need to have the same size
+    fft_size = options['fft_size']
+    if fft_size is None:
+        fft_size = pyworld.get_cheaptrick_fft_size(fs, options['f0_floor'])
+
+    sp = pyworld.cheaptrick(x, f0, t, fs, f0_floor=options['f0_floor'], fft_size=fft_size)
+    ap = pyworld.d4c(x, f0, t, fs, fft_size=fft_size)
+
+    return f0, sp, ap
 
-    # Analysis
-    dat_folder   = os.path.join(vsc.CONFIG['cachefolder'], m['module'])
+def analysis_filename(in_filename):
+    """
+    Returns the base name of the cache files of the analysis of **in_filename**: the arrays are stored
+    in :file:`{base}.f0.npy`, :file:`{base}.sp.npy` and :file:`{base}.ap.npy`, and the other information
+    in :file:`{base}.json`.
+    """
+
+    dat_folder = os.path.join(vsc.CONFIG['cachefolder'], 'world')
     if not os.path.exists(dat_folder):
         os.makedirs(dat_folder)
 
-    # To change the frame period, the default_frame_period has to be changed
-    # pyworld.default_frame_period
+    return os.path.join(dat_folder, "dat_"+vsct.signature((vsct.source_fingerprint(in_filename), 'world v'+pyworld.__version__, analysis_options())))
+
+def save_analysis(dat_filename, in_filename, f0, sp, ap, fs, rms_x, options):
+    """
+    Saves the analysis of **in_filename**, made with the analysis **options**, in the cache files of base name
+    **dat_filename** (see :py:func:`analysis_filename`). The JSON file is written last, so the analysis is only
+    found once all the arrays are written.
+    """
+
+    dtype = options['dtype']
+    for k, a in [('f0', f0), ('sp', sp.astype(dtype)), ('ap', ap.astype(dtype))]:
+        filename = dat_filename+"."+k+".npy"
+        tmp_filename = vsct.temporary_filename(filename)
+        np.save(tmp_filename, a)
+        os.replace(tmp_filename, filename)
+        vsct.job_file(filename, [in_filename], None)
+
+    filename = dat_filename+".json"
+    tmp_filename = vsct.temporary_filename(filename)
+    with open(tmp_filename, 'w') as f:
+        json.dump({'fs': fs, 'rms': rms_x, 'file': in_filename, 'world_version': pyworld.__version__, 'frame_period': options['frame_period'], 'options': options}, f)
+    os.replace(tmp_filename, filename)
+    vsct.job_file(filename, [in_filename], None)
+
+def load_analysis(dat_filename):
+    """
+    Loads the analysis saved with :py:func:`save_analysis`. The arrays are memory-mapped: they are only read
+    when they are used, and the same sound processed by several workers is only in memory once.
+
+    :return: A tuple ``(f0, sp, ap, fs, rms, frame_period)``.
+    """
+
+    with open(dat_filename+".json") as f:
+        dat = json.load(f)
+    f0, sp, ap = [np.load(dat_filename+"."+k+".npy", mmap_mode='r') for k in ['f0', 'sp', 'ap']]
+
+    # The cache does not expire, but the access is recorded for the cache eviction
+    for k in ['.json', '.f0.npy', '.sp.npy', '.ap.npy']:
+        try:
+            vsct.update_job_file(dat_filename+k)
+        except Exception as err:
+            vsl.LOG.warning("Something went wrong while updating the job-file associated with %s: %s" % (dat_filename+k, err))
+
+    return f0, sp, ap, dat['fs'], dat['rms'], dat['frame_period']
+
+def get_analysis(in_filename):
+    """
+    Returns the analysis of **in_filename**: it is loaded from the cache if it was already done (see :py:func:`load_analysis`),
+    otherwise the sound is analysed and the results are cached (see :py:func:`save_analysis`).
+
+    :return: A tuple ``(f0, sp, ap, fs, rms, frame_period)``.
+    """
 
-    dat_filename = os.path.join(dat_folder, "dat_"+vsct.signature((os.path.abspath(in_filename), 'world v'+pyworld.__version__))+'.pickle')
+    options = analysis_options()
+    dat_filename = analysis_filename(in_filename)
     try:
-        # The file already exists so we just load it
+        # The files already exist so we just load them
         t1 = time.time()
         tp1 = time.process_time()
 
-        dat = pickle.load(open(dat_filename, "rb"))
-
-        # No need to update because cache is set to None
-        #vsct.update_job_file(dat_filename)
-
         # We could check some things here like the file and the World version, but it should
         # be builtin the file signature.
-        #f0, sp, ap, fs, rms_x, sp_interp, ap_interp = dat['f0'], dat['sp'], dat['ap'], dat['fs'], dat['rms'], dat['sp_interp'], dat['ap_interp']
-        f0, sp, ap, fs, rms_x = dat['f0'], dat['sp'], dat['ap'], dat['fs'], dat['rms']
-
-        if 'frame_period' in dat and pyworld.default_frame_period != dat['frame_period']:
-            raise Exception("The frame period in the pickled file does not match that of the version of pyworld. We regenerate it.")
+        f0, sp, ap, fs, rms_x, frame_period = load_analysis(dat_filename)
 
         t2 = time.time()
         tp2 = time.process_time()
         vsl.LOG.info("[world (v%s)] Loaded f0, sp and ap from '%s' in %.2f ms (%.2f ms of processing time)" % (pyworld.__version__, dat_filename, (t2-t1)*1e3, (tp2-tp1)*1e3))
 
-        # used_files.append(dat_filename)
-
     except:
         t1 = time.time()
         tp1 = time.process_time()
         x, fs = sf.read(in_filename)
         rms_x = vsct.rms(x)
-        f0, sp, ap = pyworld.wav2world(x, fs)
+        f0, sp, ap = analyse(x, fs, options)
+        frame_period = options['frame_period']
 
-        # Note: I thought of keeping the interpolant in the pickle file, but it
+        # Note: I thought of keeping the interpolant in the cache, but it
         # makes it way too big and the processing gain is relatively small
 
-        pickle.dump({'f0': f0, 'sp': sp, 'ap': ap, 'fs': fs, 'rms': rms_x, 'file': in_filename, 'world_version': pyworld.__version__, 'frame_period': pyworld.default_frame_period}, open(dat_filename, 'wb'))
-        vsct.job_file(dat_filename, [in_filename], None)
+        save_analysis(dat_filename, in_filename, f0, sp, ap, fs, rms_x, options)
 
         t2 = time.time()
         tp2 = time.process_time()
-        vsl.LOG.info("[world (v%s)] Extracted f0, sp and ap from '%s' in %.2f ms (%.2f ms of processing time)" % (pyworld.__version__, in_filename, (t2-t1)*1e3, (tp2-tp1)*1e3))
+        vsl.LOG.info("[world (v%s)] Extracted f0, sp and ap from '%s' with %s in %.2f ms (%.2f ms of processing time)" % (pyworld.__version__, in_filename, options['f0_method'], (t2-t1)*1e3, (tp2-tp1)*1e3))
+
+    return f0, sp, ap, fs, rms_x, frame_period
+
+def process_world(in_filename, m, out_filename):
+    """
+    Processes the file **in_filename** according to parameters **m**, and stores results in **out_filename**.
+
+    The first step is to analyse the sound file to extract its f0, spectral envelope and
+    aperiodicity map. The results of this operation are cached (see :py:func:`save_analysis`).
+
+    The parameters for this module are:
+
+    :param f0: Either an absolute f0 value in Hertz ``{### Hz}``, a change in semitones ``{### st}`` or a ratio ``{\*###}``.
 
-        # created_files.append(dat_filename)
+    :param vtl: Same for vocal-tract length (only semitones and ratio).
+
+    :param duration: Either an absolute duration in seconds ``{~###s}``, an offset in seconds ``{+/-###s}``, or a ratio ``{\*###}``.
+
+    Just to be clear, these parameters must be keys of the dictionary **m**.
+    """
+
+    return sweep_world(in_filename, [m], [out_filename])[0]
+
+#: The options of the configuration the output of the module depends on.
+CONFIG_KEYS = ['worldanalysis']
+
+#: The parameters of the module that can be given as lists in a query, to make a sweep (see :py:func:`sweep_world`).
+SWEEP_KEYS = ['f0', 'vtl', 'duration']
 
+def sweep_world(in_filename, ms, out_filenames):
+    """
+    Processes the file **in_filename** according to each of the parameter sets of the list **ms** (see
+    :py:func:`process_world`), and stores the results in the corresponding files of the list **out_filenames**.
+
+    This is what the brain calls when **f0**, **vtl** or **duration** are given as lists in a query: the analysis
+    is loaded only once, the spectral envelope and aperiodicity map are only interpolated once for all the points
+    that share the same **vtl** and **duration**, and the sounds are synthesized in parallel threads (at most
+    :py:func:`cpu_share` of them).
 
-    # Modification of decomposition
-    m = parse_arguments(m)
+    :return: The list of the output files.
+    """
+
+    f0, sp, ap, fs, rms_x, frame_period = get_analysis(in_filename)
 
     nfft = (sp.shape[1]-1)*2
     f = np.arange( sp.shape[1] ) / nfft * fs
-    t = np.arange( sp.shape[0] ) * pyworld.default_frame_period / 1e3
+    t = np.arange( sp.shape[0] ) * frame_period / 1e3
+
+    envelopes = dict() # The interpolated sp and ap, for each (vtl, duration)
+    futures = list()
+    with ThreadPoolExecutor(max_workers=min(len(ms), cpu_share())) as pool:
+        for m, out_filename in zip(ms, out_filenames):
+
+            # Modification of decomposition
+            m = parse_arguments(m)
+
+            new_t = new_times(t, m['duration'], frame_period)
+            new_f = new_frequencies(f, m['vtl'])
+
+            k = repr((m['vtl'], m['duration']))
+            if k not in envelopes:
+                # Interp of spectral envelope and aperiodicity map
+                if new_f is None and new_t is None:
+                    # Both VTL and duration are unchanged
+                    new_sp, new_ap = sp, ap
+                else:
+                    interp = SeparableInterp(t, t if new_t is None else new_t, f, f if new_f is None else new_f)
+                    new_sp = interp(sp)
+                    new_ap = interp(ap)
+                envelopes[k] = regularize_arrays(new_sp, new_ap)
 
-    # F0
-    if (m['f0'] is None) or (m['f0']['u'] is None and m['f0']['v']==1) or (m['f0']['u'] is not None and m['f0']['v']==0 and not m['f0']['~']):
+            new_f0 = new_pitch(f0, m['f0'])
+            if new_t is not None:
+                new_f0 = stretch_f0(new_f0, t, new_t)
+
+            futures.append(pool.submit(synthesize, new_f0, *envelopes[k], fs, frame_period, rms_x, in_filename, out_filename))
+
+    return [fut.result() for fut in futures]
+
+def new_pitch(f0, a):
+    """
+    Applies the **f0** argument **a** (as parsed by :py:func:`parse_arguments`) to the f0 contour **f0**.
+    """
+    if (a is None) or (a['u'] is None and a['v']==1) or (a['u'] is not None and a['v']==0 and not a['~']):
         # No change
-        new_f0 = f0
-    elif m['f0']['u'] is None:
-        new_f0 = f0*m['f0']['v']
-    else:
-        if m['f0']['u']=='Hz':
-            if m['f0']['~']:
-                m_f0 = np.exp(np.mean(np.log(f0[f0!=0])))
-                new_f0 = f0 / m_f0 * m['f0']['v']
-            else:
-                new_f0 = f0 + m['f0']['v']
-        elif m['f0']['u']=='st':
-            new_f0 = f0 * 2**(m['f0']['v']/12)
+        return f0
+    elif a['u'] is None:
+        return f0*a['v']
+    elif a['u']=='Hz':
+        if a['~']:
+            m_f0 = np.exp(np.mean(np.log(f0[f0!=0])))
+            return f0 / m_f0 * a['v']
+        else:
+            return f0 + a['v']
+    elif a['u']=='st':
+        return f0 * 2**(a['v']/12)
 
-    # VTL
-    if (m['vtl'] is None) or (m['vtl']['u'] is None and m['vtl']['v']==1) or (m['vtl']['u'] is not None and m['vtl']['v']==0):
-        new_f = None
-    else:
-        if m['vtl']['u'] is None:
-            vtl_ratio = m['vtl']['v']
-        elif m['vtl']['u']=='st':
-            vtl_ratio = 2**(m['vtl']['v']/12)
-        new_f = f * vtl_ratio
-
-    # Duration
-    if (m['duration'] is None) or (m['duration']['u'] is None and m['duration']['v']==1) or (m['duration']['u'] is not None and m['duration']['v']==0 and not m['duration']['~']):
-        new_t = None
-    else:
-        if m['duration']['u'] is None:
-            # A ratio
-            new_t = np.linspace(t[0], t[-1], int(m['duration']['v']*len(t)))
-        elif m['duration']['u']=='s':
-            if m['duration']['~']:
-                # We assign a new duration
-                new_t = np.linspace(t[0], t[-1], int(m['duration']['v']/pyworld.default_frame_period*1e3))
-            else:
-                # We extend the duration with a certain offset
-                new_duration = m['duration']['v'] + t[-1] #len(t)/pyworld.default_frame_period
-                if new_duration<=0:
-                    raise ValueError("[world] This is not good, the new duration is negative or null (%.3f s)... This is what we parsed: %s." % (new_duration, repr(m['duration'])))
-                new_t = np.linspace(t[0], t[-1], int(new_duration/pyworld.default_frame_period*1e3))
-
-    # Now we rescale f0, sp and ap if necessary
-    if new_f is None and new_t is None:
-        # Both VTL and duration are unchanged
-        new_sp = sp
-        new_ap = ap
-    else:
-        if new_t is None:
-            # Duration is not changed, we keep f0 as it is
-            new_t = t
+def new_frequencies(f, a):
+    """
+    Returns the frequencies at which the spectral envelope has to be interpolated to apply the **vtl**
+    argument **a**, or ``None`` if the vocal-tract length is unchanged.
+    """
+    if (a is None) or (a['u'] is None and a['v']==1) or (a['u'] is not None and a['v']==0):
+        return None
+    if a['u'] is None:
+        vtl_ratio = a['v']
+    elif a['u']=='st':
+        vtl_ratio = 2**(a['v']/12)
+    return f * vtl_ratio
+
+def new_times(t, a, frame_period):
+    """
+    Returns the times of the frames of the output for the **duration** argument **a**, or ``None`` if the
+    duration is unchanged. The frames of the output are **frame_period** ms apart, like those of the analysis.
+    """
+    if (a is None) or (a['u'] is None and a['v']==1) or (a['u'] is not None and a['v']==0 and not a['~']):
+        return None
+    if a['u'] is None:
+        # A ratio
+        return np.linspace(t[0], t[-1], int(a['v']*len(t)))
+    elif a['u']=='s':
+        if a['~']:
+            # We assign a new duration
+            return np.linspace(t[0], t[-1], int(a['v']/frame_period*1e3))
         else:
-            # Duration is changed, we need to interpolate f0
-            # This is a bit of a tricky business because there are zeros and we do
-            # not want to interpolate those.
-            uv = new_f0==0 # The unvoiced samples
-            # We first interpolate over the unvoiced samples and stretch
-            new_f0_tmp = new_f0[np.logical_not(uv)]
-            new_f0 = spi.interp1d(t[np.logical_not(uv)], new_f0_tmp, kind='cubic', fill_value=(new_f0_tmp[0], new_f0_tmp[-1]), bounds_error=False, assume_sorted=True)(new_t)
-            # Then we stretch the voice/unvoice information
-            new_uv = spi.interp1d(t, uv*1.0, assume_sorted=True)(new_t)>.5
-            new_f0[new_uv] = 0
-
-        if new_f is None:
-            # VTL is not changed
-            new_f = f
-
-        # Interp of spectral envelope and aperiodicity map
-        new_sp = Fast2DInterp(t, f, sp)(new_t, new_f)
-        new_ap = Fast2DInterp(t, f, ap)(new_t, new_f)
-
-    new_f0, new_sp, new_ap = regularize_arrays(new_f0, new_sp, new_ap)
-    y = pyworld.synthesize(new_f0, new_sp, new_ap, fs)
+            # We extend the duration with a certain offset
+            new_duration = a['v'] + t[-1] #len(t)/frame_period
+            if new_duration<=0:
+                raise ValueError("[world] This is not good, the new duration is negative or null (%.3f s)... This is what we parsed: %s." % (new_duration, repr(a)))
+            return np.linspace(t[0], t[-1], int(new_duration/frame_period*1e3))
+
+def stretch_f0(f0, t, new_t):
+    """
+    Interpolates the f0 contour **f0**, defined at times **t**, at times **new_t**.
+    """
+    # This is a bit of a tricky business because there are zeros and we do
+    # not want to interpolate those.
+    uv = f0==0 # The unvoiced samples
+    # We first interpolate over the unvoiced samples and stretch
+    f0_tmp = f0[np.logical_not(uv)]
+    new_f0 = spi.interp1d(t[np.logical_not(uv)], f0_tmp, kind='cubic', fill_value=(f0_tmp[0], f0_tmp[-1]), bounds_error=False, assume_sorted=True)(new_t)
+    # Then we stretch the voice/unvoice information
+    new_uv = spi.interp1d(t, uv*1.0, assume_sorted=True)(new_t)>.5
+    new_f0[new_uv] = 0
+    return new_f0
+
+def synthesize(f0, sp, ap, fs, frame_period, rms_x, in_filename, out_filename):
+    """
+    Synthesizes the sound from **f0**, **sp** and **ap** (with frames **frame_period** ms apart), with the same RMS as the input **in_filename**, and
+    writes it in **out_filename**. The GIL is released during the synthesis, so it can be done in parallel threads.
+    """
+
+    f0, = regularize_arrays(f0)
+    y = pyworld.synthesize(f0, sp, ap, fs, frame_period)
 
     y = y / vsct.rms(y) * rms_x
 
@@ -318,7 +632,6 @@ def process_world(in_filename, m, out_filename):
     if s!=1:
         vsl.LOG.info("[world (v%s)] Clipping was avoided during processing of '%s' to '%s' by rescaling with a factor of %.3f (%.1f dB)." % (pyworld.__version__, in_filename, out_filename, s, 20*np.log10(s)))
 
-
     sf.write(out_filename, y, fs)
 
     return out_filename
@@ -326,77 +639,67 @@ def process_world(in_filename, m, out_filename):
 
 def regularize_arrays(*args):
     """
-    Making sure the arrays passed as arguments are in the right format for pyworld.
+    Making sure the arrays passed as arguments are in the right format for pyworld (this copies
+    the memory-mapped arrays of the analysis, that are read-only).
     """
     out = list()
     for x in args:
-        out.append( np.require(x, requirements='C'))
+        out.append( np.require(x, dtype=np.float64, requirements=['C', 'W']))
     return tuple(out)
 
 
-class Fast2DInterp():
+class SeparableInterp():
     """
-    Creates an interpolant object based on ``scipy.interpolate.RectBivariateSpline`` but
-    dealing with out of range values.
+    Resamples 2D arrays ``z`` defined on the grid (**x**, **y**) onto the grid (**new_x**, **new_y**),
+    interpolating along each axis separately. The indices and weights are computed once, when the object is
+    created, so that the same resampling can be applied to several arrays (the spectral envelope and the
+    aperiodicity map) at little cost: ``SeparableInterp(t, new_t, f, new_f)(sp)``.
 
-    The constructor is: ``Fast2DInterp(x, y, z, ofrv=None)`` where ``x`` and ``y``
-    are 1D arrays and ``z`` is a 2D array. The optional argument ``ofrv`` defines
-    the value used for out of range inputs. If ``ofrv`` is ``None``, then the
-    default behaviour of ``RectBivariateSpline`` is kept, i.e. the closest value is
-    returned.
+    Values outside of the grid take the value of the closest edge, like ``scipy.interpolate.interp2d`` used
+    to do. If the new grid is the same as the old one along an axis, no interpolation is done along that axis.
 
-    The default type is ``linear``, which then makes use of ``scipy.interpolate.interp2d``.
-    With ``cubic``, the ``RectBivariateSpline`` is used.
-
-    Note that the class is not so useful in the end when used with ``linear``, but
-    is useful if you want to use cubic-splines.
+    :param kind: `'linear'` (bilinear interpolation) or `'cubic'` (Catmull-Rom cubic convolution, which assumes
+        regularly spaced grids).
     """
 
-    def __init__(self, x, y, z, ofrv=None, type='linear'):
-        self.type = type
-
-        if self.type=='cubic':
-            self.interpolant = spi.RectBivariateSpline(x, y, z)
-        elif self.type=='linear':
-            self.interpolant = spi.interp2d(y, x, z, kind='linear')
-        else:
-            raise ValueError('Interpolant type unknown: "%s"' % type)
-
-        self.x_range = (x[0], x[-1])
-        self.y_range = (y[0], y[-1])
-
-        # Out of range value:
-        self.ofrv = ofrv
-
-    def is_in_range(self, w, r):
-        return np.logical_and(w>=r[0], w<=r[1])
-
-    def __call__(self, x, y):
-        return self.interp(x, y)
-
-    def interp_(self, x, y):
-        if self.type=='cubic':
-            return self.interpolant(x, y)
-        elif self.type=='linear':
-            return self.interpolant(y, x)
-
-    def interp(self, x, y):
-        if (np.isscalar(x) or len(x)==1) and (np.isscalar(y) or len(y)==1):
-            if self.ofrv is not None:
-                if self.is_in_range(x, self.x_range) and self.is_in_range(y, self.y_range):
-                    o = self.interp_(x, y)[0,0]
-                else:
-                    o = self.ofrv
-            else:
-                o = self.interp_(x, y)[0,0]
+    def __init__(self, x, new_x, y, new_y, kind='linear'):
+        if kind not in ['linear', 'cubic']:
+            raise ValueError('Interpolant type unknown: "%s"' % kind)
+        self.kind = kind
+        self.x_weights = self.weights(x, new_x, kind)
+        self.y_weights = self.weights(y, new_y, kind)
+
+    @staticmethod
+    def weights(x, new_x, kind):
+        """
+        Returns the indices of the points of **x** used to interpolate at each point of **new_x**, and their weights,
+        as two arrays of shape ``(len(new_x), n)`` (n is 2 for `'linear'`, and 4 for `'cubic'`). Returns ``None`` if
+        **new_x** is the same as **x**.
+        """
+        x = np.asarray(x, dtype=float)
+        new_x = np.asarray(new_x, dtype=float)
+        if len(x)==len(new_x) and np.array_equal(x, new_x):
+            return None
+
+        new_x = np.clip(new_x, x[0], x[-1])
+        i = np.clip(np.searchsorted(x, new_x, side='right')-1, 0, len(x)-2)
+        u = (new_x - x[i]) / (x[i+1] - x[i])
+
+        if kind=='linear':
+            return np.stack((i, i+1), axis=1), np.stack((1-u, u), axis=1)
         else:
-            o = self.interp_(x, y)
-
-            if self.ofrv is not None:
-                s = np.logical_and(self.is_in_range(xx, self.x_range), self.is_in_range(yy, self.y_range))
-                o[s] = self.ofrv
-
-        return o
+            idx = np.clip(i[:,None] + np.arange(-1, 3)[None,:], 0, len(x)-1)
+            w = np.stack((((2-u)*u-1)*u, ((3*u-5)*u*u+2), ((4-3*u)*u+1)*u, (u-1)*u*u), axis=1)/2
+            return idx, w
+
+    def __call__(self, z):
+        if self.x_weights is not None:
+            idx, w = self.x_weights
+            z = sum([w[:,k,None] * z[idx[:,k],:] for k in range(idx.shape[1])])
+        if self.y_weights is not None:
+            idx, w = self.y_weights
+            z = sum([w[None,:,k] * z[:,idx[:,k]] for k in range(idx.shape[1])])
+        return z
 
 
 if __name__=="__main__":
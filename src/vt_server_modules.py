@@ -23,6 +23,23 @@ There are two types of modules:
         via other means. Sometimes they do need source files and therefore need to
         declare themselves which files they have used.
 
+Modifier modules can also provide an ``array_...`` function that works on the sound
+itself rather than on files: it takes the sound as a :py:class:`numpy.ndarray`, its
+sampling frequency and the module parameters, and returns the processed sound and
+its sampling frequency. The brain uses it to chain modules in memory, without writing
+and reading intermediate files. The ``process_...`` function of these modules is then
+a simple adapter (see :py:func:`array_adapter`).
+
+Modifier modules can also provide a ``sweep_...`` function, and list in ``SWEEP_KEYS``
+the parameters that can be given as lists of values in a query. The query is then a sweep:
+the brain calls the ``sweep_...`` function once, with the list of the parameter sets of all the
+combinations of values, and a list of output files. This lets the module share work between
+the points of the sweep.
+
+If the output of a module depends on options of the configuration, the module lists them in
+``CONFIG_KEYS``. These options are then part of the signature of the queries that use the
+module, so that changing them does not serve sounds made with the former options from the cache.
+
 .. Created on 2020-03-24.
 """
 
@@ -43,18 +60,29 @@ class vt_module:
     :param process_function: The main process function of the module.
     :param name: The name of the module, which is also the keyword used in queries. If ``None``, the name is derived from the process_function name.
     :param type: The type of module ('modifier' or 'generator').
+    :param array_function: The array-level function of the module, if any (only for 'modifier' modules).
+    :param sweep_function: The sweep function of the module, if any (only for 'modifier' modules).
+    :param sweep_keys: The parameters that make a sweep when they are given as lists.
+    :param config_keys: The options of the configuration the output of the module depends on.
 
     To access the name of the module, use the attribute :py:attr:__name__.
 
     To call the process function, you can use the class instance as a callable.
     """
 
-    def __init__(self, process_function, name=None, type='modifier'):
+    def __init__(self, process_function, name=None, type='modifier', array_function=None, sweep_function=None, sweep_keys=None, config_keys=None):
         if name is None:
             name = process_function.__name__.replace('process_', '', 1)
         self.__name__ = name
         self.process_function = process_function
         self.type = type
+        if type!='modifier':
+            array_function = None
+            sweep_function = None
+        self.array_function = array_function
+        self.sweep_function = sweep_function
+        self.sweep_keys = sweep_keys if sweep_function is not None and sweep_keys is not None else []
+        self.config_keys = config_keys if config_keys is not None else []
 
     def __call__(self, *args):
         return self.process_function(*args)
@@ -63,6 +91,17 @@ class vt_module:
 #: The :py:data:`MODULE` is used to dispatch stack item modules to their corresponding function
 MODULES = dict()
 
+def array_adapter(array_function, in_filename, m, out_filename):
+    """
+    Applies the array-level function **array_function** of a module to the file **in_filename**,
+    and saves the result in **out_filename**. This is what the ``process_...`` function of
+    modules that have an ``array_...`` function does.
+    """
+    x, fs = sf.read(in_filename)
+    y, fs = array_function(x, fs, m)
+    sf.write(out_filename, y, fs)
+    return out_filename
+
 #-------------------------------------------------------
 
 def process_time_reverse(in_filename, m, out_filename):
@@ -70,11 +109,12 @@ def process_time_reverse(in_filename, m, out_filename):
     `"time-reverse"` flips temporally the input. It doesn't take any argument.
 
     """
-    x, fs = sf.read(in_filename)
-    sf.write(out_filename, np.flip(x, axis=0), fs)
-    return out_filename
+    return array_adapter(array_time_reverse, in_filename, m, out_filename)
+
+def array_time_reverse(x, fs, m):
+    return np.flip(x, axis=0), fs
 
-MODULES['time-reverse'] = vt_module(process_time_reverse, 'time-reverse')
+MODULES['time-reverse'] = vt_module(process_time_reverse, 'time-reverse', array_function=array_time_reverse)
 
 
 #-------------------------------------------------------
@@ -90,24 +130,24 @@ def process_channel_patch(in_filename, m, out_filename):
         the right channel.
 
     """
+    return array_adapter(array_channel_patch, in_filename, m, out_filename)
+
+def array_channel_patch(x, fs, m):
 
     if 'coefs' not in m:
         raise ValueError("[channel-patch] `coefs` needs to be provided.")
 
-    x, fs = sf.read(in_filename)
-
     if len(x.shape)>1 and x.shape[1]>1:
         raise ValueError("[channel-patch] Can only be applied to mono signals.")
 
+    x = x.reshape(-1)
     y = np.zeros((x.shape[0], len(m['coefs'])))
     for i,a in enumerate(m['coefs']):
         y[:,i] = a * x
 
-    sf.write(out_filename, y, fs)
-
-    return out_filename
+    return y, fs
 
-MODULES['channel-patch'] = vt_module(process_channel_patch, 'channel-patch')
+MODULES['channel-patch'] = vt_module(process_channel_patch, 'channel-patch', array_function=array_channel_patch)
 
 #-------------------------------------------------------
 
@@ -135,6 +175,9 @@ def process_mixin(in_filename, m, out_filename):
     If the two sound files are not the same shape (number of channels), the one with fewer channels is duplicated to have the same number of channels as the one with the most.
 
     """
+    return array_adapter(array_mixin, in_filename, m, out_filename)
+
+def array_mixin(A, fs_A, m):
 
     if 'pad' not in m:
         m['pad'] = [0,0,0,0]
@@ -143,7 +186,8 @@ def process_mixin(in_filename, m, out_filename):
     if 'levels' not in m:
         m['levels'] = [0, 0]
 
-    A, fs_A = sf.read(in_filename, always_2d=True)
+    if len(A.shape)==1:
+        A = A.reshape((-1, 1))
     B, fs_B = sf.read(m['file'], always_2d=True)
 
     # Normalizing the sampling frequency
@@ -191,13 +235,11 @@ def process_mixin(in_filename, m, out_filename):
 
     y, s = vsct.clipping_prevention(y)
     if s!=1:
-        vsl.LOG.info("[mixin] Clipping was avoided during processing of '%s' to '%s' by rescaling with a factor of %.3f (%.1f dB)." % (in_filename, out_filename, s, 20*np.log10(s)))
-
-    sf.write(out_filename, y, fs)
+        vsl.LOG.info("[mixin] Clipping was avoided while mixing in '%s' by rescaling with a factor of %.3f (%.1f dB)." % (m['file'], s, 20*np.log10(s)))
 
-    return out_filename
+    return y, fs
 
-MODULES['mixin'] = vt_module(process_mixin)
+MODULES['mixin'] = vt_module(process_mixin, array_function=array_mixin)
 
 #-------------------------------------------------------
 
@@ -206,6 +248,9 @@ def process_pad(in_filename, m, out_filename):
     `"pad"` adds silence before and/or after the sound. It takes **before** and/or **after**
     as arguments, specifying the duration of silence in seconds.
     """
+    return array_adapter(array_pad, in_filename, m, out_filename)
+
+def array_pad(x, fs, m):
 
     for k in ['before', 'after']:
         if k not in m:
@@ -215,17 +260,14 @@ def process_pad(in_filename, m, out_filename):
         except:
             raise ValueError("'%s' has to be convertible to a float (%s given)" % (k,repr(m[k])))
 
-    x, fs = sf.read(in_filename)
-
     if len(x.shape)>1:
         x = np.concatenate((np.zeros((int(m['before']*fs), x.shape[1])), x, np.zeros((int(m['after']*fs), x.shape[1]))), axis=0)
     else:
         x = np.concatenate((np.zeros((int(m['before']*fs),)), x, np.zeros((int(m['after']*fs),))), axis=0)
-    sf.write(out_filename, x, fs)
 
-    return out_filename
+    return x, fs
 
-MODULES['pad'] = vt_module(process_pad)
+MODULES['pad'] = vt_module(process_pad, array_function=array_pad)
 
 #-------------------------------------------------------
 
@@ -243,6 +285,9 @@ def process_slice(in_filename, m, out_filename):
 
     If the start time is larger than the end time, an error is raised.
     """
+    return array_adapter(array_slice, in_filename, m, out_filename)
+
+def array_slice(x, fs, m):
 
     for k in ['start', 'end']:
         if k not in m:
@@ -252,7 +297,8 @@ def process_slice(in_filename, m, out_filename):
         except:
             raise ValueError("'%s' has to be convertible to a float (%s given)" % (k,repr(m[k])))
 
-    x, fs = sf.read(in_filename, always_2d=True)
+    if len(x.shape)==1:
+        x = x.reshape((-1, 1))
 
     i1 = round(fs*m['start'])
     if m['end']==0:
@@ -268,11 +314,9 @@ def process_slice(in_filename, m, out_filename):
 
     x = x[i1:i2,]
 
-    sf.write(out_filename, x, fs)
-
-    return out_filename
+    return x, fs
 
-MODULES['slice'] = vt_module(process_slice)
+MODULES['slice'] = vt_module(process_slice, array_function=array_slice)
 
 #-------------------------------------------------------
 
@@ -288,8 +332,10 @@ def process_ramp(in_filename, m, out_filename):
         Either 'linear' (default) or 'cosine'.
 
     """
+    return array_adapter(array_ramp, in_filename, m, out_filename)
+
+def array_ramp(x, fs, m):
 
-    x, fs = sf.read(in_filename)
     if type(m['duration']) == type(0.0) or type(m['duration'])==type(0):
         dur = [m['duration']]*2
     elif type(m['duration']) != type([]):
@@ -300,11 +346,9 @@ def process_ramp(in_filename, m, out_filename):
 
     x = vsct.ramp(x, fs, dur, m['shape'])
 
-    sf.write(out_filename, x, fs)
-
-    return out_filename
+    return x, fs
 
-MODULES['ramp'] = vt_module(process_ramp)
+MODULES['ramp'] = vt_module(process_ramp, array_function=array_ramp)
 
 #-------------------------------------------------------
 # Look for modules in the same folder:
@@ -330,7 +374,9 @@ def discover_modules():
                 mod_type = getattr(mo, 'MODULE_TYPE')
             else:
                 mod_type = 'modifier'
-            MODULES[mod_label] = vt_module(mod_process, mod_label, mod_type)
+            mod_array = getattr(mo, "array_"+mod_label, None)
+            mod_sweep = getattr(mo, "sweep_"+mod_label, None)
+            MODULES[mod_label] = vt_module(mod_process, mod_label, mod_type, mod_array, mod_sweep, getattr(mo, 'SWEEP_KEYS', None), getattr(mo, 'CONFIG_KEYS', None))
             vsl.LOG.info("Found module %s providing handler %s for keyword '%s'" % (mod_name, mod_process_name, mod_label))
         except Exception as e:
             vsl.LOG.error("Error while attempting importation of module %s:\n%s" % (m, e))
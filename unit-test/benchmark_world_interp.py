@@ -0,0 +1,65 @@
+# benchmark_world_interp
+#
+# Compares the interpolation of the spectral envelope and aperiodicity map done by
+# the world module (vt_server_module_world.SeparableInterp) with the scipy interpolants
+# it replaces. Run from the unit-test folder: python benchmark_world_interp.py
+
+import sys, time
+import numpy as np
+import scipy.interpolate as spi
+
+sys.path.insert(0, '../src')
+from vt_server_module_world import SeparableInterp
+
+def timeit(fn, n=20):
+    fn()
+    t0 = time.perf_counter()
+    for i in range(n):
+        fn()
+    return (time.perf_counter()-t0)/n
+
+def scipy_interp(t, f, sp, ap, new_t, new_f):
+    # Bilinear interpolation with scipy, one interpolant per array (as was done with interp2d)
+    if hasattr(spi, 'interp2d'):
+        try:
+            return spi.interp2d(f, t, sp, kind='linear')(new_f, new_t), spi.interp2d(f, t, ap, kind='linear')(new_f, new_t)
+        except NotImplementedError:
+            pass
+    new_t = np.clip(new_t, t[0], t[-1])
+    new_f = np.clip(new_f, f[0], f[-1])
+    return spi.RectBivariateSpline(t, f, sp, kx=1, ky=1)(new_t, new_f), spi.RectBivariateSpline(t, f, ap, kx=1, ky=1)(new_t, new_f)
+
+def separable_interp(t, f, sp, ap, new_t, new_f, kind='linear'):
+    interp = SeparableInterp(t, new_t, f, new_f, kind)
+    return interp(sp), interp(ap)
+
+if __name__ == '__main__':
+
+    fs = 44100
+    frame_period = 5.
+    nfft = 2048
+    n_frames = 600 # 3 s of sound
+
+    rng = np.random.default_rng(1)
+    sp = np.abs(rng.standard_normal((n_frames, nfft//2+1)))
+    ap = rng.uniform(size=(n_frames, nfft//2+1))
+
+    f = np.arange(sp.shape[1]) / nfft * fs
+    t = np.arange(sp.shape[0]) * frame_period / 1e3
+
+    for label, new_t, new_f in [
+            ("vtl -3.8st", t, f * 2**(-3.8/12)),
+            ("vtl +3.8st, duration *1.3", np.linspace(t[0], t[-1], int(1.3*len(t))), f * 2**(3.8/12))]:
+
+        print("%s (%d x %d -> %d x %d):" % (label, len(t), len(f), len(new_t), len(new_f)))
+
+        ref_sp, ref_ap = scipy_interp(t, f, sp, ap, new_t, new_f)
+        new_sp, new_ap = separable_interp(t, f, sp, ap, new_t, new_f)
+        print("   Max. difference with scipy: %.3g (sp), %.3g (ap)" % (np.max(np.abs(ref_sp-new_sp)), np.max(np.abs(ref_ap-new_ap))))
+
+        t_scipy = timeit(lambda: scipy_interp(t, f, sp, ap, new_t, new_f))
+        t_linear = timeit(lambda: separable_interp(t, f, sp, ap, new_t, new_f))
+        t_cubic = timeit(lambda: separable_interp(t, f, sp, ap, new_t, new_f, 'cubic'))
+        print("   scipy:              %7.2f ms" % (t_scipy*1e3))
+        print("   SeparableInterp:    %7.2f ms (x%.1f)" % (t_linear*1e3, t_scipy/t_linear))
+        print("   SeparableInterp(c): %7.2f ms (x%.1f)" % (t_cubic*1e3, t_scipy/t_cubic))
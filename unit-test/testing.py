@@ -2,11 +2,19 @@
 
 import unittest
 
-import socket, sys, json, time, subprocess, signal, shutil, os
+import socket, sys, json, time, subprocess, signal, shutil, os, tempfile, datetime
 import soundfile as sf
 import numpy as np
 from matplotlib import pyplot as plt
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import vt_server_config as vsc
+import vt_server_common_tools as vsct
+import vt_server_cache as vscache
+import vt_server_brain
+import vt_server_module_world as vsw
+from concurrent.futures import ProcessPoolExecutor
+
 
 HOST, PORT = "127.0.0.1", 1996
 
@@ -20,7 +28,8 @@ def make_config_file():
         "cachefolder": "./cache",
         "cacheformat": "flac",
         "cacheformatoptions": {},
-        "lame": "/usr/bin/lame"
+        "lame": "/usr/bin/lame",
+        "workers": 2
     }
     """ % (HOST, PORT)
     with open("vt_server.conf.json", "w") as cfg_file:
@@ -35,7 +44,15 @@ def cleanup():
 
 def start_server():
     p = subprocess.Popen(['python',  '../src/vt_server.py'])
-    time.sleep(.6)
+    # The server starts its workers before accepting connections
+    for i in range(300):
+        try:
+            socket.create_connection((HOST, PORT), 1).close()
+            break
+        except OSError:
+            if p.poll() is not None:
+                break
+            time.sleep(.1)
     return p
 
 def stop_server(p):
@@ -67,6 +84,20 @@ def send(data):
             print("Something went wrong in decoding JSON:\n%s" % received)
             return False
 
+def send_many(data_list):
+    """
+    Sends all the requests of the list on a single connection, without waiting for
+    the responses, and returns the responses in the order they were received.
+    """
+
+    data_ = "".join([json.dumps(data) + "\n" for data in data_list])
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.connect((HOST, PORT))
+        sock.sendall(bytes(data_, "utf-8"))
+        f = sock.makefile('rb')
+        return [json.loads(f.readline()) for data in data_list]
+
 class QueryTests(unittest.TestCase):
 
     p = None
@@ -128,6 +159,18 @@ class QueryTests(unittest.TestCase):
 
             self.assertTrue(res['out']=='ok')
 
+        with self.subTest("In-memory stack"):
+            q = self._base_query()
+            q['stack'].append({'module': "pad", 'before': 250e-3})
+            q['stack'].append({'module': "time-reverse"})
+            r = send(q)
+            self.assertEqual(r['out'], 'ok')
+
+            x, fs = sf.read(q['file'])
+            y, fs_y = sf.read(r['details'])
+            self.assertEqual(fs, fs_y)
+            self.assertTrue(np.array_equal(y, np.flip(np.concatenate((np.zeros(int(.25*fs)), x)))))
+
         # Nest
 
         with self.subTest("Empty stack"):
@@ -234,6 +277,143 @@ class QueryTests(unittest.TestCase):
             self.assertEqual(r['out'], 'ok')
             self.assertSoundFilesEqual(r['details'], './audio/test_concat-subq.flac')
 
+        with self.subTest("Parallel subqueries"):
+            q = self._base_query()
+            q['file'] = [{'file': 'audio/Beer.wav', 'stack': [{'module': 'world', 'f0': f0, 'vtl': "+2st"}]} for f0 in ["+5st", "-5st"]]
+            r = send(q)
+            self.assertEqual(r['out'], 'ok')
+
+            # The sub-queries were processed by the two workers at the same time
+            times = list()
+            with open('./log/vt_server.log') as f:
+                log = f.read().splitlines()
+            for sq in q['file']:
+                h = send(dict(sq, action='process', mode='hash'))['details']+'.flac'
+                t = [datetime.datetime.strptime(l[1:24], "%Y-%m-%d %H:%M:%S,%f") for l in log if ("] [%s] Processing request {" % h) in l or ("] [%s] Finished with processing the stack." % h) in l]
+                self.assertEqual(len(t), 2)
+                times.append(t)
+            self.assertLess(max([t[0] for t in times]), min([t[1] for t in times]))
+
+        with self.subTest("Batch"):
+            qs = list()
+            for d in [.1, .2, .1]:
+                q = self._base_query()
+                q['stack'].append({'module': 'pad', 'before': d})
+                qs.append(q)
+            r = send({'action': 'process_many', 'queries': qs, 'mode': 'sync'})
+            self.assertEqual(r['out'], 'ok')
+            self.assertEqual(len(r['details']), 3)
+            self.assertEqual(r['details'][0]['details'], r['details'][2]['details'])
+            self.assertNotEqual(r['details'][0]['details'], r['details'][1]['details'])
+
+            qs[2]['format'] = 'wav'
+            r = send({'action': 'process_many', 'queries': qs, 'mode': 'sync'})
+            self.assertEqual(r['out'], 'ok')
+            self.assertTrue(r['details'][0]['details'].endswith('.flac'))
+            self.assertTrue(r['details'][2]['details'].endswith('.wav'))
+
+        with self.subTest("Sweep"):
+            q = self._base_query()
+            q['stack'].append({'module': 'world', 'f0': ["-2st", "+2st"], 'vtl': ["-3.8st", "+3.8st"]})
+            r = send(q)
+            self.assertEqual(r['out'], 'ok')
+            self.assertEqual(len(r['details']), 4)
+            q = self._base_query()
+            q['stack'].append({'module': 'world', 'f0': "+2st", 'vtl': "-3.8st"})
+            r1 = send(q)
+            self.assertEqual(r1['details'], r['details'][2]['details'])
+
+        with self.subTest("Failing sweep"):
+            q = self._base_query()
+            q['stack'].append({'module': 'world', 'f0': ["+2st", "bogus"]})
+            q['mode'] = 'async'
+
+            r = {'out': 'wait'}
+            for i in range(100):
+                # The error is longer than what send() reads
+                r = send_many([q])[0]
+                if r['out']!='wait':
+                    break
+                time.sleep(.2)
+            self.assertEqual(r['out'], 'error')
+            with open('./log/vt_server.log') as f:
+                self.assertEqual(f.read().count("Processing sweep of 2 points"), 1)
+
+        with self.subTest("Long-poll"):
+            q = self._base_query()
+            q['stack'].append({'module': 'pad', 'before': 2})
+            q['mode'] = 'async'
+            q['timeout'] = 30
+            r = send(q)
+            self.assertEqual(r['out'], 'ok')
+
+        with self.subTest("Pipelining"):
+            q1 = self._base_query()
+            q1['stack'].append({'module': 'pad', 'before': 1})
+            q1['keep_alive'] = True
+            q1['id'] = 1
+            q2 = {'action': 'status', 'keep_alive': True, 'id': 'status'}
+            q3 = self._base_query()
+            q3['stack'].append({'module': 'pad', 'after': 1})
+            q3['id'] = 3
+
+            r = send_many([q1, q2, q3])
+            r = {x['id']: x for x in r}
+            self.assertEqual(set(r.keys()), {1, 'status', 3})
+            self.assertTrue(all([x['out']=='ok' for x in r.values()]))
+
+        with self.subTest("Coalescing"):
+            q1 = self._base_query()
+            q1['stack'].append({'module': 'pad', 'before': 3})
+            q1['keep_alive'] = True
+            q1['id'] = 1
+            q2 = dict(q1)
+            q2['keep_alive'] = False
+            q2['id'] = 2
+
+            r = send_many([q1, q2])
+            self.assertTrue(all([x['out']=='ok' for x in r]))
+            self.assertEqual(r[0]['details'], r[1]['details'])
+
+            # The same query in another format is not coalesced
+            q1 = dict(q1, stack=[{'module': 'pad', 'before': 4}])
+            q2 = dict(q1, format='wav', keep_alive=False, id=2)
+            r = {x['id']: x for x in send_many([q1, q2])}
+            self.assertTrue(all([x['out']=='ok' for x in r.values()]))
+            self.assertTrue(r[1]['details'].endswith('.flac'))
+            self.assertTrue(r[2]['details'].endswith('.wav'))
+
+        with self.subTest("Bytes"):
+            q = self._base_query()
+            q['stack'].append({'module': 'pad', 'before': 2})
+            q['return'] = 'bytes'
+
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                sock.connect((HOST, PORT))
+                sock.sendall(bytes(json.dumps(q) + "\n", "utf-8"))
+                f = sock.makefile('rb')
+                r = json.loads(f.readline())
+                payload = f.read(r['size'])
+
+            self.assertEqual(r['out'], 'ok')
+            with open(r['details'], 'rb') as f:
+                self.assertEqual(payload, f.read())
+
+            # A sweep makes several files, they cannot be sent
+            q['stack'] = [{'module': 'world', 'f0': ["-2st", "+2st"]}]
+            r = send(q)
+            self.assertEqual(r['out'], 'error')
+
+        with self.subTest("Hot cache"):
+            q = self._base_query()
+            q['stack'].append({'module': 'pad', 'after': 3})
+            r = send(q)
+            self.assertEqual(r['out'], 'ok')
+            r1 = send(q)
+            self.assertEqual(r1, r)
+            with open('./log/vt_server.log') as f:
+                self.assertIn("Found %s in the hot cache" % r['details'], f.read())
+
         with self.subTest("Async"):
             q = self._base_query()
             q['stack'].append({'module': 'world', 'f0': "-18st", 'vtl': "+5st"})
@@ -248,5 +428,304 @@ class QueryTests(unittest.TestCase):
             self.assertSoundFilesEqual(r['details'], './audio/test_async.flac')
 
 
+class CacheTests(unittest.TestCase):
+    """
+    Tests of the cache maintenance (:py:mod:`vt_server_cache`), without a server. Each test gets its own
+    cache folder, with its own cache index.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fold = os.path.join(self.tmp, 'cache')
+        os.makedirs(self.fold)
+        self.config = dict(vsc.CONFIG)
+        vsc.CONFIG['cachefolder'] = self.fold
+        vsc.CONFIG['cachededup'] = True
+
+    def tearDown(self):
+        vsc.CONFIG.clear()
+        vsc.CONFIG.update(self.config)
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _make(self, filename, sources, data=None):
+        """
+        Writes **filename** and records it in the cache index as made from **sources**.
+        """
+        if data is None:
+            data = filename.encode()
+        content = vsct.write_cache_file(filename, data)
+        vsct.job_file(filename, sources, content=content)
+        return filename
+
+    def _targets(self):
+        return sorted([t for t, in vsct.cache_index_execute("SELECT target FROM jobs", (), self.fold).fetchall()])
+
+    def test_cleanup(self):
+        """
+        A modified source file only removes the files that were made from it, and the files made from those.
+        """
+
+        src_a = os.path.join(self.tmp, 'a.wav')
+        src_b = os.path.join(self.tmp, 'b.wav')
+        for f in [src_a, src_b]:
+            with open(f, 'wb') as fh:
+                fh.write(f.encode())
+
+        a1 = self._make(os.path.join(self.fold, 'a1.flac'), [src_a])
+        a2 = self._make(os.path.join(self.fold, 'a2.flac'), [a1])
+        b1 = self._make(os.path.join(self.fold, 'b1.flac'), [src_b])
+        ab = self._make(os.path.join(self.fold, 'ab.flac'), [b1, src_b])
+
+        # The source is edited after the files were made
+        t = time.time()+10
+        os.utime(src_a, (t, t))
+
+        vscache.cleanup_cache(self.fold, verbose=False)
+
+        self.assertFalse(os.path.exists(a1))
+        self.assertFalse(os.path.exists(a2))
+        for f in [b1, ab, src_a, src_b]:
+            self.assertTrue(os.path.exists(f))
+        self.assertEqual(self._targets(), sorted([b1, ab]))
+
+    def test_cleanup_checkpoint(self):
+        """
+        An interrupted cleanup is resumed from its checkpoint.
+        """
+
+        missing = os.path.join(self.tmp, 'missing.wav')
+        targets = [self._make(os.path.join(self.fold, 'f%d.flac' % i), [missing]) for i in range(6)]
+        checkpoint = os.path.join(self.tmp, 'checkpoint.json')
+
+        cleanup_cache_batch = vscache.cleanup_cache_batch
+        calls = list()
+        def interrupted_batch(fold, after, *args, **kwargs):
+            if len(calls)==1:
+                raise KeyboardInterrupt()
+            calls.append(after)
+            return cleanup_cache_batch(fold, after, *args, batch_size=2, **kwargs)
+
+        def batch(fold, after, *args, **kwargs):
+            calls.append(after)
+            return cleanup_cache_batch(fold, after, *args, batch_size=2, **kwargs)
+
+        try:
+            vscache.cleanup_cache_batch = interrupted_batch
+            with self.assertRaises(KeyboardInterrupt):
+                vscache.cleanup_cache(self.fold, verbose=False, checkpoint=checkpoint)
+
+            with open(checkpoint) as f:
+                self.assertEqual(json.load(f)['after'], targets[1])
+            self.assertEqual(self._targets(), targets[2:])
+
+            calls.clear()
+            vscache.cleanup_cache_batch = batch
+            vscache.cleanup_cache(self.fold, verbose=False, checkpoint=checkpoint)
+        finally:
+            vscache.cleanup_cache_batch = cleanup_cache_batch
+
+        self.assertEqual(calls[0], targets[1])
+        self.assertEqual(self._targets(), [])
+        self.assertFalse(any([os.path.exists(f) for f in targets]))
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_eviction(self):
+        """
+        Only files that no other file was made from are evicted, and identical files (hard links) are counted once.
+        """
+
+        src = os.path.join(self.tmp, 'src.wav')
+        with open(src, 'wb') as f:
+            f.write(b'src')
+
+        inter = self._make(os.path.join(self.fold, 'inter.npy'), [src], b'i'*1000)
+        leaf  = self._make(os.path.join(self.fold, 'leaf.flac'), [inter], b'l'*1000)
+        dup_1 = self._make(os.path.join(self.fold, 'dup_1.flac'), [inter], b'd'*1000)
+        dup_2 = self._make(os.path.join(self.fold, 'dup_2.flac'), [src], b'd'*1000)
+        self.assertEqual(os.stat(dup_1).st_ino, os.stat(dup_2).st_ino)
+
+        # The intermediate file is the least recently used
+        for i, f in enumerate([inter, dup_1, dup_2, leaf]):
+            vsct.cache_index_execute("UPDATE jobs SET last_access = ? WHERE target = ?", (i, f), self.fold)
+
+        # 3000 bytes of data, below the high watermark
+        self.assertEqual(vscache.evict_cache(self.fold, 3200/1024**2, 'lru', verbose=False), (0, 0))
+        self.assertEqual(len(self._targets()), 4)
+
+        # The duplicates only free their data once both are gone
+        self.assertEqual(vscache.evict_cache(self.fold, 2000/1024**2, 'lru', verbose=False), (3, 2000))
+        self.assertTrue(os.path.exists(inter))
+        self.assertTrue(os.path.exists(src))
+        self.assertEqual(self._targets(), [inter])
+
+    def test_dedup(self):
+        """
+        Identical files of the cache are hard links to the same data.
+        """
+
+        src = os.path.join(self.tmp, 'src.wav')
+        a = self._make(os.path.join(self.fold, 'a.flac'), [src], b'same')
+        b = self._make(os.path.join(self.fold, 'b.flac'), [src], b'same')
+        c = self._make(os.path.join(self.fold, 'c.flac'), [src], b'other')
+        self.assertEqual(os.stat(a).st_ino, os.stat(b).st_ino)
+        self.assertNotEqual(os.stat(a).st_ino, os.stat(c).st_ino)
+
+        # A file written by a module is linked when it is recorded
+        d = os.path.join(self.fold, 'd.flac')
+        with open(d, 'wb') as f:
+            f.write(b'same')
+        vsct.job_file(d, [src])
+        self.assertEqual(os.stat(a).st_ino, os.stat(d).st_ino)
+        self.assertEqual(vsct.read_job_file(d)['content'], vsct.read_job_file(a)['content'])
+
+        # Removing one of the links leaves the data to the others
+        os.remove(a)
+        with open(b, 'rb') as f:
+            self.assertEqual(f.read(), b'same')
+
+        # Files that are gone from the cache are not linked to
+        os.remove(b)
+        os.remove(d)
+        e = os.path.join(self.fold, 'e.flac')
+        with open(e, 'wb') as f:
+            f.write(b'same')
+        self.assertFalse(vsct.link_duplicate(e, vsct.file_hash(e), 4))
+        with open(e, 'rb') as f:
+            self.assertEqual(f.read(), b'same')
+
+        vsc.CONFIG['cachededup'] = False
+        g = self._make(os.path.join(self.fold, 'g.flac'), [src], b'other')
+        self.assertNotEqual(os.stat(c).st_ino, os.stat(g).st_ino)
+
+
+class SignatureTests(unittest.TestCase):
+    """
+    Tests of the job signatures (:py:func:`vt_server_brain.job_signature`), without a server.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.config = dict(vsc.CONFIG)
+        vsc.CONFIG['cachefolder'] = os.path.join(self.tmp, 'cache')
+
+    def tearDown(self):
+        vsc.CONFIG.clear()
+        vsc.CONFIG.update(self.config)
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _write(self, filename, data):
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    def test_rewritten_source(self):
+        """
+        Rewriting the source file of a query, or a file given to one of its modules, changes the signature of the query.
+        """
+
+        src = os.path.join(self.tmp, 'src.wav')
+        masker = os.path.join(self.tmp, 'masker.wav')
+        self._write(src, b'source')
+        self._write(masker, b'masker')
+        q = {'file': src, 'stack': [{'module': 'mixin', 'file': masker, 'levels': [0, -6]}]}
+
+        for fingerprint in ['stat', 'content']:
+            vsc.CONFIG['fingerprint'] = fingerprint
+            h = vt_server_brain.job_signature(q)
+
+            self._write(src, b'source, for the %s fingerprint' % fingerprint.encode())
+            h_src = vt_server_brain.job_signature(q)
+            self.assertNotEqual(h_src, h)
+
+            self._write(masker, b'masker, for the %s fingerprint' % fingerprint.encode())
+            h_masker = vt_server_brain.job_signature(q)
+            self.assertNotEqual(h_masker, h_src)
+
+            self.assertNotEqual(vt_server_brain.module_cache_filename(src, q['stack'][0], 'flac'),
+                vt_server_brain.module_cache_filename(src, dict(q['stack'][0], file=src), 'flac'))
+
+        # Touching a file does not change its content
+        t = time.time()+10
+        os.utime(masker, (t, t))
+        self.assertEqual(vt_server_brain.job_signature(q), h_masker)
+
+        vsc.CONFIG['fingerprint'] = 'path'
+        h = vt_server_brain.job_signature(q)
+        self._write(masker, b'masker')
+        self.assertEqual(vt_server_brain.job_signature(q), h)
+
+
+class WorldAnalysisTests(unittest.TestCase):
+    """
+    Tests of the analysis of long sounds in chunks (:py:func:`vt_server_module_world.analyse`), without a server.
+    """
+
+    def setUp(self):
+        x, self.fs = sf.read('./audio/Beer.wav')
+        # Sentences separated by silences
+        parts = list()
+        for i in range(8):
+            parts += [x*(1+.1*i), np.zeros(int(.4*self.fs))]
+        self.x = np.concatenate(parts)
+        self.options = dict(vsw.analysis_options(), chunk_duration=3.)
+        self.analysis_pool = vsw.analysis_pool
+
+    def tearDown(self):
+        vsw.analysis_pool = self.analysis_pool
+        vsw.close_analysis_pool()
+
+    def test_chunks(self):
+        """
+        The chunks are split in silences, and the stitched analysis matches the analysis in one go.
+        """
+
+        x, fs = self.x, self.fs
+        boundaries = vsw.chunk_boundaries(x, fs, self.options)
+        self.assertEqual(len(boundaries), 5)
+
+        hop = self.options['frame_period']*fs/1000
+        n = int(hop)
+        energy = np.mean(x**2)
+        for b in boundaries[1:-1]:
+            self.assertAlmostEqual(b/hop, round(b/hop))
+            self.assertLess(np.mean(x[b-n:b+n]**2), energy/100)
+
+        # The chunks are analysed in parallel processes
+        vsw.ANALYSIS_POOL = ProcessPoolExecutor(2)
+        vsw.analysis_pool = lambda: vsw.ANALYSIS_POOL
+        f0, sp, ap = vsw.analyse(x, fs, self.options)
+        f0_1, sp_1, ap_1 = vsw.analyse_chunk(x, fs, self.options)
+
+        self.assertEqual(f0.shape, f0_1.shape)
+        self.assertEqual(sp.shape, sp_1.shape)
+        self.assertEqual(ap.shape, ap_1.shape)
+
+        # Away from the seams, the chunks have enough context to find the same f0
+        t = np.arange(len(f0))*hop
+        far = np.all([np.abs(t-b) > vsw.CHUNK_MARGIN*fs/2 for b in boundaries[1:-1]], axis=0)
+        self.assertTrue(np.array_equal(f0[far]>0, f0_1[far]>0))
+        voiced = far & (f0_1>0)
+        self.assertGreater(np.sum(voiced), 100)
+        self.assertLess(np.max(np.abs(f0[voiced]-f0_1[voiced])/f0_1[voiced]), .05)
+
+    def test_broken_pool(self):
+        """
+        If the pool of the analysis cannot start, the chunks are analysed in the current process.
+        """
+
+        x, fs = self.x, self.fs
+        vsw.analysis_pool = lambda: None
+        f0, sp, ap = vsw.analyse(x, fs, self.options)
+
+        # The processes of the pool die as they start
+        vsw.ANALYSIS_POOL = ProcessPoolExecutor(2, initializer=os._exit, initargs=(1,))
+        vsw.analysis_pool = lambda: vsw.ANALYSIS_POOL
+        f0_b, sp_b, ap_b = vsw.analyse(x, fs, self.options)
+
+        self.assertIsNone(vsw.ANALYSIS_POOL)
+        self.assertTrue(np.array_equal(f0, f0_b))
+        self.assertTrue(np.array_equal(sp, sp_b))
+        self.assertTrue(np.array_equal(ap, ap_b))
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)